@@ -0,0 +1,195 @@
+'''
+Benchmark suite: times number generation, dataframe build, export and plotting over a grid of input sizes
+
+usage: python benchmark.py [--sizes 1e3 1e4 1e5 1e6] [--stages ...] [--repeat 3] [--config config.ini]
+                           [--output results.json] [--baseline baseline.json] [--threshold 0.2]
+
+Results are written as json (to stdout unless --output is given); a results file can be used as --baseline
+of later runs. With a baseline the exit code is 1 if any stage is slower than baseline * (1 + threshold).
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import bokeh
+import numpy as np
+import pandas as pd
+
+import storage
+from utils import SettingsParser, ToolBox
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+
+STAGES = ('generate_range', 'generate_families', 'create_dataframe',
+          'export_csv', 'export_parquet', 'export_feather', 'export_npz', 'plot')
+
+DEFAULT_REPEAT = 3
+
+# relative slowdown over the baseline that counts as a regression
+DEFAULT_THRESHOLD = 0.2
+
+# stages faster than this in the baseline are too noisy to compare
+DEFAULT_MIN_SECONDS = 0.01
+
+
+def make_toolbox(config_file: str, **overrides) -> ToolBox:
+    '''
+    Return a toolbox over the config file with the given settings replaced
+    Caches are disabled so that every stage does its full work
+    '''
+    options = SettingsParser(config_file=config_file).get_settings()
+    options.run_prime_table_file = 'none'
+    options.run_result_cache = False
+    options.run_create_csv = False
+    options.graph_headless = True
+    for key, value in overrides.items():
+        setattr(options, key, value)
+    toolbox = ToolBox(options)
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.WARNING)
+    toolbox.set_logger(logger)
+    return toolbox
+
+
+def best_time(function: Callable, repeat: int) -> float:
+    '''
+    Return the fastest of repeat timed calls, in seconds
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def benchmark_size(config_file: str, size: int, stages: List[str], repeat: int) -> Dict[str, float]:
+    '''
+    Time the stages for one input size: a range of size numbers, or families of size numbers in total
+    '''
+    timings = {}
+    range_toolbox = make_toolbox(config_file, set_mode='range', set_range_min=2, set_range_max=size + 1)
+    if 'generate_range' in stages:
+        timings['generate_range'] = best_time(range_toolbox.generate_continuous_number_list, repeat)
+
+    if 'generate_families' in stages:
+        family_toolbox = make_toolbox(config_file, set_mode='family')
+        family_count = len(family_toolbox.opt.set_families)
+        family_toolbox.opt.set_identity_factor_mode = 'count'
+        family_toolbox.opt.set_identity_factor_minimum_mode = 'origin'
+        family_toolbox.opt.set_identity_factor_count = max(size // family_count, 1)
+        timings['generate_families'] = best_time(family_toolbox.generate_number_families, repeat)
+
+    numbers = range_toolbox.generate_continuous_number_list()
+    if 'create_dataframe' in stages:
+        timings['create_dataframe'] = best_time(lambda: range_toolbox.create_dataframe(numbers), repeat)
+    dataframe, factor_batch = range_toolbox.create_dataframe(numbers)
+
+    for output_format in storage.OUTPUT_EXTENSIONS:
+        stage = f'export_{output_format}'
+        if stage not in stages:
+            continue
+        if output_format in ('parquet', 'feather') and storage.pa is None:
+            continue
+        range_toolbox.opt.run_output_format = output_format
+        timings[stage] = best_time(lambda: range_toolbox.write_data(dataframe, '.', f'benchmark_{size}', factor_batch),
+                                   repeat)
+
+    if 'plot' in stages:
+        timings['plot'] = best_time(lambda: range_toolbox.plot_data(dataframe, factor_batch), repeat)
+    return timings
+
+
+def run_benchmarks(config_file: str, sizes: List[int], stages: List[str], repeat: int) -> Dict:
+    '''
+    Run the stages over all sizes in a temporary folder; returns the results with environment details
+    '''
+    config_file = os.path.abspath(config_file)
+    results = {stage: {} for stage in stages}
+    working_folder = os.getcwd()
+    with tempfile.TemporaryDirectory() as benchmark_folder:
+        os.chdir(benchmark_folder)
+        try:
+            for size in sizes:
+                for stage, seconds in benchmark_size(config_file, size, stages, repeat).items():
+                    results[stage][str(size)] = seconds
+        finally:
+            os.chdir(working_folder)
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'bokeh': bokeh.__version__,
+        },
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def find_regressions(results: Dict, baseline: Dict, threshold: float, min_seconds: float) -> List[Dict]:
+    '''
+    Compare the results with a baseline; returns the stages and sizes slower than baseline * (1 + threshold)
+    '''
+    regressions = []
+    for stage, timings in results['results'].items():
+        baseline_timings = baseline['results'].get(stage, {})
+        for size, seconds in timings.items():
+            baseline_seconds = baseline_timings.get(size)
+            if baseline_seconds is None or baseline_seconds < min_seconds:
+                continue
+            ratio = seconds / baseline_seconds
+            if ratio > 1 + threshold:
+                regressions.append({'stage': stage, 'size': int(size), 'baseline': baseline_seconds,
+                                    'seconds': seconds, 'ratio': ratio})
+    return regressions
+
+
+def parse_arguments(arguments: List[str]):
+    parser = argparse.ArgumentParser(description='Benchmark the number generation, data and plotting stages')
+    parser.add_argument('--sizes', nargs='+', type=lambda text: int(float(text)), default=list(DEFAULT_SIZES),
+                        help='input sizes (numbers per run), ex. 1e3 1e5 1e7')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='timed calls per stage; the fastest is kept')
+    parser.add_argument('--config', default='config.ini', help='config file the benchmark settings are based on')
+    parser.add_argument('--output', help='results file (json); printed to stdout if not given')
+    parser.add_argument('--baseline', help='results file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative slowdown that fails the comparison, ex. 0.2 = 20%%')
+    parser.add_argument('--min-seconds', type=float, default=DEFAULT_MIN_SECONDS,
+                        help='baseline timings below this are not compared')
+    return parser.parse_args(arguments)
+
+
+def main(arguments: List[str] = None) -> int:
+    args = parse_arguments(sys.argv[1:] if arguments is None else arguments)
+    results = run_benchmarks(args.config, args.sizes, args.stages, args.repeat)
+
+    if args.output:
+        with open(args.output, 'wt') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline, 'rt') as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = find_regressions(results, baseline, args.threshold, args.min_seconds)
+    for regression in regressions:
+        print(f"REGRESSION {regression['stage']} @ {regression['size']}: "
+              f"{regression['baseline']:.4f}s -> {regression['seconds']:.4f}s (x{regression['ratio']:.2f})",
+              file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,449 @@
+from itertools import count as count_from
+import math
+from typing import Callable, List
+import numpy as np
+
+import primes
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+# largest batch maximum for which a smallest-prime-factor table is built
+DEFAULT_SPF_TABLE_LIMIT = 100000000
+
+# numbers above this do not fit int64 arrays and are kept as python integers
+INT64_MAX = 2**63 - 1
+
+# Miller-Rabin with these bases is deterministic for every n < 3.3 * 10^24
+MILLER_RABIN_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+DETERMINISTIC_LIMIT = 3317044064679887385961981
+
+SMALL_PRIMES = primes.sieve_primes(1000).tolist()
+
+
+def integer_array(numbers) -> np.ndarray:
+    '''
+    Return numbers as an int64 array, or as an object array of python integers if they do not fit
+    '''
+    try:
+        return np.asarray(numbers, dtype=np.int64)
+    except OverflowError:
+        return np.array([int(number) for number in numbers], dtype=object)
+
+
+class FactorBatch():
+    '''
+    Prime factorizations of a batch of numbers in a ragged (flat values plus offsets) layout
+    The factors of numbers[i] are values[offsets[i]:offsets[i + 1]], in ascending order
+    '''
+
+    def __init__(self, numbers: np.ndarray, values: np.ndarray, offsets: np.ndarray) -> None:
+        self.numbers = numbers
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __getitem__(self, index: slice):
+        '''
+        Return a slice of rows as a new batch
+        '''
+        start, stop, _ = index.indices(len(self))
+        offsets = self.offsets[start:stop + 1]
+        return FactorBatch(self.numbers[start:stop], self.values[offsets[0]:offsets[-1]], offsets - offsets[0])
+
+    def take(self, rows: np.ndarray):
+        '''
+        Return the given rows as a new batch
+        '''
+        counts = self.counts()[rows]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        positions = np.repeat(self.offsets[:-1][rows] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return FactorBatch(self.numbers[rows], self.values[positions], offsets)
+
+    def counts(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def factor_lists(self) -> List[List[int]]:
+        '''
+        Return the factors of every number as python lists
+        '''
+        values = self.values.tolist()
+        offsets = self.offsets.tolist()
+        return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def render(self, drop_last: bool = False, separator: str = ', ', bookends=('[ ', ' ]')) -> List[str]:
+        '''
+        Render the factors of every number as text, optionally without the largest (identity) factor
+        '''
+        values = [str(value) for value in self.values.tolist()]
+        offsets = self.offsets.tolist()
+        end_shift = 1 if drop_last else 0
+        return [bookends[0] + separator.join(values[start:max(start, end - end_shift)]) + bookends[1]
+                for start, end in zip(offsets[:-1], offsets[1:])]
+
+    @classmethod
+    def from_lists(cls, numbers, factor_lists: List[List[int]]):
+        counts = np.fromiter((len(factors) for factors in factor_lists),
+                             dtype=np.int64, count=len(factor_lists))
+        offsets = np.zeros(len(factor_lists) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        values = integer_array([factor for factors in factor_lists for factor in factors])
+        return cls(integer_array(numbers), values, offsets)
+
+
+def factorize_with_table(numbers: np.ndarray, spf_table: np.ndarray) -> FactorBatch:
+    '''
+    Factorize a whole batch by repeated smallest-prime-factor lookups
+    Every round divides each unfinished number by its smallest prime factor,
+    so the factors of a number come out in ascending order
+    '''
+    numbers = np.asarray(numbers, dtype=np.int64)
+    remaining = numbers.copy()
+    rounds = []
+    rows = np.flatnonzero(remaining > 1)
+    while len(rows):
+        factors = spf_table[remaining[rows]].astype(np.int64)
+        rounds.append((rows, factors))
+        remaining[rows] //= factors
+        rows = rows[remaining[rows] > 1]
+
+    counts = np.zeros(len(numbers), dtype=np.int64)
+    for rows, factors in rounds:
+        counts[rows] += 1
+    offsets = np.zeros(len(numbers) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    values = np.empty(int(offsets[-1]), dtype=np.int64)
+    # rows still active in round n have exactly n earlier factors
+    for position, (rows, factors) in enumerate(rounds):
+        values[offsets[rows] + position] = factors
+    return FactorBatch(numbers, values, offsets)
+
+
+def factorize_with_sieve(numbers: np.ndarray, base_primes: np.ndarray) -> FactorBatch:
+    '''
+    Factorize a batch with a segmented factor sieve over [min, max] of the batch
+    base_primes must hold every prime up to sqrt(max); each one divides out its multiples in the segment,
+    and the cofactor left above 1 is the one prime factor larger than sqrt(max)
+    Memory is proportional to the span of the batch, not to its largest number
+    '''
+    numbers = np.asarray(numbers, dtype=np.int64)
+    if not len(numbers):
+        return FactorBatch(numbers, np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64))
+    lowerbound = int(numbers.min())
+    upperbound = int(numbers.max())
+    remaining = np.arange(lowerbound, upperbound + 1, dtype=np.int64)
+    base_primes = base_primes[:np.searchsorted(base_primes, math.isqrt(upperbound), side='right')]
+    small_count = int(np.searchsorted(base_primes, len(remaining)))
+    rounds = []
+    for prime in base_primes[:small_count].tolist():
+        first_multiple = max(-(-lowerbound // prime) * prime, prime)
+        multiples = np.arange(first_multiple - lowerbound, len(remaining), prime, dtype=np.int64)
+        # one round per power of the prime
+        while len(multiples):
+            rounds.append((multiples, prime))
+            remaining[multiples] //= prime
+            multiples = multiples[remaining[multiples] % prime == 0]
+
+    # a prime at least as large as the span has at most one multiple in it; they are all located at once
+    large_primes = base_primes[small_count:]
+    first_multiples = np.maximum(-(-lowerbound // large_primes) * large_primes, large_primes)
+    hits = first_multiples <= upperbound
+    positions = first_multiples[hits] - lowerbound
+    hit_primes = large_primes[hits]
+    order = np.argsort(positions, kind='stable')
+    positions = positions[order]
+    hit_primes = hit_primes[order]
+    # a position may have several large prime factors: one round per rank of the prime at its position
+    ranks = np.arange(len(positions)) - np.searchsorted(positions, positions)
+    for rank in range(int(ranks.max()) + 1 if len(ranks) else 0):
+        in_rank = ranks == rank
+        multiples = positions[in_rank]
+        prime = hit_primes[in_rank]
+        while len(multiples):
+            rounds.append((multiples, prime))
+            remaining[multiples] //= prime
+            divisible = remaining[multiples] % prime == 0
+            multiples = multiples[divisible]
+            prime = prime[divisible]
+    cofactors = np.flatnonzero(remaining > 1)
+    rounds.append((cofactors, remaining[cofactors]))
+
+    # positions are unique within a round, so every round adds at most one factor per position
+    span_counts = np.zeros(len(remaining), dtype=np.int64)
+    for positions, _ in rounds:
+        span_counts[positions] += 1
+    span_offsets = np.zeros(len(remaining) + 1, dtype=np.int64)
+    np.cumsum(span_counts, out=span_offsets[1:])
+    # rounds run in ascending prime order and the cofactor comes last, so each position fills in ascending order
+    span_values = np.empty(int(span_offsets[-1]), dtype=np.int64)
+    next_slot = span_offsets[:-1].copy()
+    for positions, factors in rounds:
+        span_values[next_slot[positions]] = factors
+        next_slot[positions] += 1
+
+    rows = numbers - lowerbound
+    counts = span_offsets[rows + 1] - span_offsets[rows]
+    offsets = np.zeros(len(numbers) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    gather = np.repeat(span_offsets[rows] - offsets[:-1], counts) + np.arange(offsets[-1])
+    return FactorBatch(numbers, span_values[gather], offsets)
+
+
+def factorize_each(numbers, factorize: Callable[[int], List[int]]) -> FactorBatch:
+    '''
+    Factorize a batch one number at a time with the given function
+    '''
+    numbers = [int(number) for number in numbers]
+    return FactorBatch.from_lists(numbers, [factorize(number) for number in numbers])
+
+
+class FactorizationBackend():
+    '''
+    Base class of the factorization backends used by ToolBox.factorize_numbers
+    '''
+    name = 'base'
+
+    def factorize(self, numbers) -> FactorBatch:
+        '''
+        Factorize a batch of numbers
+        '''
+        return factorize_each(numbers, self.factor)
+
+    def factor(self, number: int) -> List[int]:
+        '''
+        Return the prime factors of a single number in ascending order
+        '''
+        raise NotImplementedError
+
+
+class SpfTableBackend(FactorizationBackend):
+    '''
+    Smallest-prime-factor table up to the batch maximum; the whole batch is reduced at once
+    '''
+    name = 'spf_table'
+
+    def factorize(self, numbers) -> FactorBatch:
+        numbers = np.asarray(numbers, dtype=np.int64)
+        largest_number = int(numbers.max()) if len(numbers) else 0
+        return factorize_with_table(numbers, primes.smallest_prime_factor_table(largest_number))
+
+    def factor(self, number: int) -> List[int]:
+        return self.factorize([number]).factor_lists()[0]
+
+
+class SegmentedSieveBackend(FactorizationBackend):
+    '''
+    Segmented factor sieve over the span of each batch; suited for chunks of a large range,
+    where a smallest-prime-factor table would have to reach the largest number of every chunk
+    The base primes are kept between batches and only grown when a batch needs larger ones
+    '''
+    name = 'segmented_sieve'
+
+    def __init__(self) -> None:
+        self.base_primes = np.empty(0, dtype=np.int64)
+        self.base_limit = 0
+
+    def factorize(self, numbers) -> FactorBatch:
+        numbers = np.asarray(numbers, dtype=np.int64)
+        largest_number = int(numbers.max()) if len(numbers) else 0
+        base_limit = math.isqrt(largest_number)
+        if base_limit > self.base_limit:
+            self.base_primes = primes.sieve_primes(base_limit)
+            self.base_limit = base_limit
+        return factorize_with_sieve(numbers, self.base_primes)
+
+    def factor(self, number: int) -> List[int]:
+        return self.factorize([number]).factor_lists()[0]
+
+
+class PollardBrentBackend(FactorizationBackend):
+    '''
+    Trial division by small primes, then deterministic Miller-Rabin and Pollard-Brent rho
+    Suited for numbers below 2^64
+    '''
+    name = 'pollard_brent'
+
+    def factor(self, number: int) -> List[int]:
+        number = self.integer(number)
+        factors = []
+        for prime in SMALL_PRIMES:
+            if prime * prime > number:
+                break
+            while number % prime == 0:
+                factors.append(prime)
+                number //= prime
+        pending = [number] if number > 1 else []
+        while pending:
+            composite = pending.pop()
+            if composite < SMALL_PRIMES[-1] ** 2 or self.is_prime(composite):
+                # no factor below the trial division bound is left, so small cofactors are prime
+                factors.append(int(composite))
+                continue
+            divisor = self.find_divisor(composite)
+            pending.extend([divisor, composite // divisor])
+        return sorted(factors)
+
+    def integer(self, number: int) -> int:
+        '''
+        Convert number to the integer type the arithmetic runs on
+        '''
+        return int(number)
+
+    def is_prime(self, number: int) -> bool:
+        return miller_rabin(number, MILLER_RABIN_BASES)
+
+    def gcd(self, a: int, b: int) -> int:
+        return math.gcd(a, b)
+
+    def find_divisor(self, number: int) -> int:
+        '''
+        Pollard-Brent rho: return a non-trivial divisor of a composite number
+        '''
+        batch_size = 128
+        for increment in count_from(1):
+            y, cycle_length, product, divisor = 2, 1, 1, 1
+            while divisor == 1:
+                x = y
+                for _ in range(cycle_length):
+                    y = (y * y + increment) % number
+                steps = 0
+                while steps < cycle_length and divisor == 1:
+                    saved_y = y
+                    for _ in range(min(batch_size, cycle_length - steps)):
+                        y = (y * y + increment) % number
+                        product = product * abs(x - y) % number
+                    divisor = self.gcd(product, number)
+                    steps += batch_size
+                cycle_length *= 2
+            if divisor == number:
+                # the batched product overshot; retrace one step at a time
+                divisor = 1
+                while divisor == 1:
+                    saved_y = (saved_y * saved_y + increment) % number
+                    divisor = self.gcd(abs(x - saved_y), number)
+            if divisor != number:
+                return divisor
+
+
+class BigIntegerBackend(PollardBrentBackend):
+    '''
+    Pollard-Brent rho on arbitrary-precision integers, for numbers above the 64-bit range
+    Uses gmpy2 when it is installed; above 3.3 * 10^24 primality is probabilistic
+    '''
+    name = 'big_integer'
+
+    def integer(self, number: int) -> int:
+        # trial division, rho steps and gcds all stay in gmpy2 integers; factor returns python ints
+        if gmpy2 is not None:
+            return gmpy2.mpz(int(number))
+        return int(number)
+
+    def is_prime(self, number: int) -> bool:
+        if gmpy2 is not None:
+            return gmpy2.is_prime(number, 50)
+        if number < DETERMINISTIC_LIMIT:
+            return miller_rabin(number, MILLER_RABIN_BASES)
+        return miller_rabin(number, SMALL_PRIMES[:64])
+
+    def gcd(self, a: int, b: int) -> int:
+        if gmpy2 is not None:
+            return gmpy2.gcd(a, b)
+        return math.gcd(a, b)
+
+
+FACTORIZATION_BACKENDS = {
+    SpfTableBackend.name: SpfTableBackend,
+    SegmentedSieveBackend.name: SegmentedSieveBackend,
+    PollardBrentBackend.name: PollardBrentBackend,
+    BigIntegerBackend.name: BigIntegerBackend,
+}
+
+
+def is_prime(number: int) -> bool:
+    '''
+    Deterministic primality test for numbers below 3.3 * 10^24
+    '''
+    return miller_rabin(int(number), MILLER_RABIN_BASES)
+
+
+def miller_rabin(number: int, bases) -> bool:
+    '''
+    Miller-Rabin primality test with the given bases
+    '''
+    if number < 2:
+        return False
+    for prime in SMALL_PRIMES[:16]:
+        if number % prime == 0:
+            return number == prime
+    odd_part = number - 1
+    twos = 0
+    while odd_part % 2 == 0:
+        odd_part //= 2
+        twos += 1
+    for base in bases:
+        x = pow(base, odd_part, number)
+        if x == 1 or x == number - 1:
+            continue
+        for _ in range(twos - 1):
+            x = x * x % number
+            if x == number - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def concatenate_batches(factor_batches: List[FactorBatch]) -> FactorBatch:
+    '''
+    Join factor batches end to end
+    '''
+    if not factor_batches:
+        empty = np.empty(0, dtype=np.int64)
+        return FactorBatch(empty, empty, np.zeros(1, dtype=np.int64))
+    numbers = np.concatenate([batch.numbers for batch in factor_batches])
+    values = np.concatenate([batch.values for batch in factor_batches])
+    counts = np.concatenate([batch.counts() for batch in factor_batches])
+    offsets = np.zeros(len(numbers) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return FactorBatch(numbers, values, offsets)
+
+
+def family_factor_batches(family_factor_lists: List[List[int]], identity_factors: np.ndarray) -> List[FactorBatch]:
+    '''
+    Build the factor batches of all families at once, without factorizing the products
+    identity_factors holds one row of identity primes per family;
+    the numbers are the broadcast product of the family products and those rows
+    '''
+    identity_factors = np.asarray(identity_factors, dtype=np.int64)
+    products = [math.prod(family_factors) for family_factors in family_factor_lists]
+    family_products = integer_array(products)
+    largest_identity_factor = int(identity_factors.max()) if identity_factors.size else 0
+    # compared in python integers; an int64 product would wrap around instead of exceeding the limit
+    if max(products, default=0) * largest_identity_factor > INT64_MAX:
+        # products past int64 are built from python integers
+        family_products = family_products.astype(object)
+        numbers = family_products[:, None] * identity_factors.astype(object)
+    else:
+        numbers = family_products[:, None] * identity_factors
+    count = identity_factors.shape[1]
+
+    # families with the same number of factors are sorted together
+    family_batches = [None] * len(family_factor_lists)
+    family_sizes = [len(family_factors) for family_factors in family_factor_lists]
+    for size in set(family_sizes):
+        members = [index for index, family_size in enumerate(family_sizes) if family_size == size]
+        rows = np.empty((len(members), count, size + 1), dtype=np.int64)
+        rows[:, :, :-1] = np.array([family_factor_lists[member] for member in members],
+                                   dtype=np.int64).reshape(len(members), 1, size)
+        rows[:, :, -1] = identity_factors[members]
+        rows.sort(axis=2)
+        offsets = np.arange(0, count * (size + 1) + 1, size + 1, dtype=np.int64)
+        for position, member in enumerate(members):
+            family_batches[member] = FactorBatch(
+                numbers[member], rows[position].ravel(), offsets)
+    return family_batches
@@ -0,0 +1,52 @@
+from typing import Dict
+import numpy as np
+
+from factorization import FactorBatch
+
+
+def compute_metrics(factor_batch: FactorBatch) -> Dict[str, np.ndarray]:
+    '''
+    Compute the per-number metrics for a whole factor batch at once
+    ideal: the number's root of degree len(factors)
+    deviation: mean absolute deviation of the prime factors from the ideal factor
+    anti_slope: number / deviation (0 for zero deviation)
+    family_product: product of all factors but the largest one
+    identity_factor: the largest factor
+    attractor: family_product * len(factors)
+    '''
+    numbers = factor_batch.numbers
+    values = factor_batch.values
+    counts = factor_batch.counts()
+    # reduceat cannot express empty segments, so only factorized rows are reduced
+    factorized = counts > 0
+    starts = factor_batch.offsets[:-1][factorized]
+    ends = factor_batch.offsets[1:][factorized]
+
+    # numbers past int64 arrive as python integers in object arrays
+    float_numbers = numbers.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ideal = np.power(float_numbers, 1 / counts)
+        # prime powers have an exact root; keep their deviation at exactly 0
+        prime_powers = values[starts] == values[ends - 1]
+        ideal[np.flatnonzero(factorized)[prime_powers]] = values[starts[prime_powers]]
+        deviations = np.abs(values.astype(np.float64) - np.repeat(ideal, counts))
+        deviation = np.zeros(len(numbers), dtype=np.float64)
+        deviation[factorized] = np.add.reduceat(
+            deviations, starts) / counts[factorized]
+        anti_slope = np.where(deviation > 0, float_numbers / deviation, 0.0)
+
+    family_values = values.astype(numbers.dtype)
+    family_values[ends - 1] = 1
+    family_product = np.ones(len(numbers), dtype=family_values.dtype)
+    family_product[factorized] = np.multiply.reduceat(family_values, starts)
+    identity_factor = np.zeros(len(numbers), dtype=values.dtype)
+    identity_factor[factorized] = values[ends - 1]
+
+    return {
+        'ideal': ideal,
+        'deviation': deviation,
+        'anti_slope': anti_slope,
+        'family_product': family_product,
+        'identity_factor': identity_factor,
+        'attractor': family_product * counts,
+    }
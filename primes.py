@@ -0,0 +1,231 @@
+from contextlib import contextmanager
+import math
+import os
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# default sieve segment size: one byte per number, sized to fit a typical L2 cache
+DEFAULT_SEGMENT_SIZE = 262144
+
+
+def sieve_primes(limit: int) -> np.ndarray:
+    '''
+    Return all primes up to and including limit as an int64 array
+    '''
+    if limit < 2:
+        return np.empty(0, dtype=np.int64)
+    is_prime = np.ones(limit + 1, dtype=bool)
+    is_prime[:2] = False
+    is_prime[4::2] = False
+    for prime in range(3, math.isqrt(limit) + 1, 2):
+        if is_prime[prime]:
+            is_prime[prime * prime::2 * prime] = False
+    return np.flatnonzero(is_prime).astype(np.int64)
+
+
+def sieve_segments(lowerbound: int, upperbound: int, segment_size: int = DEFAULT_SEGMENT_SIZE):
+    '''
+    Segmented sieve of Eratosthenes over [lowerbound, upperbound]
+    Yields (segment_start, is_prime) pairs, where is_prime is a boolean mask of the segment
+    '''
+    lowerbound = max(lowerbound, 0)
+    if upperbound < lowerbound:
+        return
+    base_primes = sieve_primes(math.isqrt(upperbound)).tolist()
+    for segment_start in range(lowerbound, upperbound + 1, segment_size):
+        segment_end = min(segment_start + segment_size - 1, upperbound)
+        is_prime = np.ones(segment_end - segment_start + 1, dtype=bool)
+        if segment_start < 2:
+            is_prime[:2 - segment_start] = False
+        for prime in base_primes:
+            square = prime * prime
+            if square > segment_end:
+                break
+            first_multiple = max(square, -(-segment_start // prime) * prime)
+            is_prime[first_multiple - segment_start::prime] = False
+        yield segment_start, is_prime
+
+
+def range_number_segments(lowerbound: int, upperbound: int, include_primes: bool, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                          prime_table=None):
+    '''
+    Yield the numbers in [lowerbound, upperbound] as int64 arrays, one sieve segment at a time
+    Primes are skipped unless include_primes is set
+    Primality is read from prime_table when one is given
+    '''
+    if prime_table is not None:
+        segments = prime_table.segments(lowerbound, upperbound, segment_size)
+    else:
+        segments = sieve_segments(lowerbound, upperbound, segment_size)
+    for segment_start, is_prime in segments:
+        numbers = np.arange(segment_start, segment_start +
+                            len(is_prime), dtype=np.int64)
+        if not include_primes:
+            numbers = numbers[~is_prime]
+        yield numbers
+
+
+def smallest_prime_factor_table(limit: int) -> np.ndarray:
+    '''
+    Return the smallest-prime-factor table for 0..limit
+    table[n] is the smallest prime dividing n (0 for 0 and 1)
+    '''
+    dtype = np.uint32 if limit < 2**32 else np.int64
+    table = np.zeros(max(limit, 1) + 1, dtype=dtype)
+    table[2::2] = 2
+    for prime in range(3, math.isqrt(limit) + 1, 2):
+        if table[prime] == 0:
+            # even multiples are already claimed by 2
+            multiples = table[prime * prime::2 * prime]
+            multiples[multiples == 0] = prime
+    unmarked = table == 0
+    unmarked[:2] = False
+    table[unmarked] = np.flatnonzero(unmarked)
+    return table
+
+
+def primes_between(lowerbound: int, upperbound: int, segment_size: int = DEFAULT_SEGMENT_SIZE) -> np.ndarray:
+    '''
+    Return the primes in [lowerbound, upperbound] as an int64 array
+    '''
+    segments = [np.flatnonzero(is_prime) + segment_start
+                for segment_start, is_prime in sieve_segments(lowerbound, upperbound, segment_size)]
+    if not segments:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(segments).astype(np.int64)
+
+
+def primes_from(start: int, count: int, segment_size: int = DEFAULT_SEGMENT_SIZE) -> np.ndarray:
+    '''
+    Return the first count primes greater than or equal to start
+    '''
+    found = []
+    total = 0
+    lowerbound = max(start, 2)
+    span = segment_size
+    while total < count:
+        upperbound = lowerbound + span - 1
+        chunk = primes_between(lowerbound, upperbound, segment_size)
+        found.append(chunk)
+        total += len(chunk)
+        lowerbound = upperbound + 1
+        span *= 2
+    if not found:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(found)[:count]
+
+
+@contextmanager
+def file_lock(file_name: str):
+    '''
+    Hold an exclusive lock on file_name (created if missing) across processes
+    '''
+    with open(file_name, 'a+b') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class PrimeTable():
+    '''
+    Persistent table of consecutive primes
+    The primes are stored as raw uint64 in a file that is memory-mapped on load
+    and extended with the segmented sieve whenever a run needs primes past its end
+    Growth happens under a lock file, so runs sharing the table never interleave their writes
+    '''
+
+    def __init__(self, file_name: str, segment_size: int = DEFAULT_SEGMENT_SIZE) -> None:
+        self.file_name = file_name
+        self.segment_size = segment_size
+        self._load()
+
+    def _load(self):
+        size = os.path.getsize(self.file_name) if os.path.exists(self.file_name) else 0
+        # a partially written trailing entry is ignored here and cut off before the next growth
+        length = size // 8
+        if length:
+            self.primes = np.memmap(self.file_name, dtype=np.uint64, mode='r', shape=(length,))
+        else:
+            self.primes = np.empty(0, dtype=np.uint64)
+
+    @property
+    def largest(self) -> int:
+        '''
+        Every prime up to this value is in the table
+        '''
+        return int(self.primes[-1]) if len(self.primes) else 1
+
+    def ensure(self, limit: int):
+        '''
+        Grow the table until it holds every prime up to limit
+        '''
+        if limit <= self.largest:
+            return
+        folder = os.path.dirname(self.file_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with file_lock(self.file_name + '.lock'):
+            # another run may have grown the table meanwhile
+            self.primes = None
+            self._load()
+            largest = self.largest
+            if limit <= largest:
+                return
+            # grow in whole segments so that small requests do not trigger repeated sieving
+            limit = -(-limit // self.segment_size) * self.segment_size
+            length = len(self.primes)
+            self.primes = None
+            with open(self.file_name, 'ab') as table_file:
+                # drop a torn trailing entry so that the new primes stay aligned
+                table_file.truncate(length * 8)
+                # one segment in memory at a time; the table stays a run of consecutive primes if interrupted
+                for segment_start, is_prime in sieve_segments(largest + 1, limit, self.segment_size):
+                    table_file.write((np.flatnonzero(is_prime) + segment_start).astype(np.uint64))
+            self._load()
+
+    def primes_between(self, lowerbound: int, upperbound: int) -> np.ndarray:
+        '''
+        Return the primes in [lowerbound, upperbound] as an int64 array
+        '''
+        self.ensure(upperbound)
+        first = np.searchsorted(self.primes, max(lowerbound, 0))
+        last = np.searchsorted(self.primes, upperbound, side='right')
+        return np.asarray(self.primes[first:last], dtype=np.int64)
+
+    def primes_from(self, start: int, count: int) -> np.ndarray:
+        '''
+        Return the first count primes greater than or equal to start
+        '''
+        upperbound = max(start, 2) + self.segment_size
+        while True:
+            self.ensure(upperbound)
+            first = np.searchsorted(self.primes, max(start, 0))
+            if len(self.primes) - first >= count:
+                return np.asarray(self.primes[first:first + count], dtype=np.int64)
+            upperbound *= 2
+
+    def segments(self, lowerbound: int, upperbound: int, segment_size: int = DEFAULT_SEGMENT_SIZE):
+        '''
+        Same as sieve_segments, with primality read from the table
+        '''
+        self.ensure(upperbound)
+        for segment_start in range(max(lowerbound, 0), upperbound + 1, segment_size):
+            segment_end = min(segment_start + segment_size - 1, upperbound)
+            is_prime = np.zeros(segment_end - segment_start + 1, dtype=bool)
+            is_prime[self.primes_between(segment_start, segment_end) - segment_start] = True
+            yield segment_start, is_prime
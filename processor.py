@@ -1,13 +1,23 @@
+import cProfile
 from datetime import datetime
 import logging
+import os
+import time
+import profiling
+import run_report
+import server
 from utils import SettingsParser, ToolBox
 
 
 class Processor():
 
     def __init__(self, config_file='config.ini') -> None:
-        self.opt = SettingsParser(config_file=config_file).get_settings()
-        self.tb = ToolBox(self.opt)
+        self.timer = run_report.StageTimer()
+        with self.timer.stage('config_parse'):
+            self.opt = SettingsParser(config_file=config_file).get_settings()
+        if self.opt.run_profile_memory:
+            self.timer.memory = run_report.MemoryTracker(trace_allocations=self.opt.run_profile_memory != 'rss')
+        self.tb = ToolBox(self.opt, self.timer)
         self.logger = self.set_up_logger()
         self.tb.set_logger(self.logger)
 
@@ -74,6 +84,9 @@ class Processor():
             self.logger.debug(
                 f'primes: {"included" if self.opt.set_include_primes else "excluded"}]')
 
+        elif self.opt.set_mode == 'file':
+            self.logger.debug(f'input file: {self.opt.set_csv_file_name}')
+
         self.logger.info('GRAPH')
         self.logger.info(
             f'graph size: {self.opt.graph_width}/{self.opt.graph_height} x {self.opt.graph_point_size}pt')
@@ -81,7 +94,11 @@ class Processor():
         self.logger.debug(f'Colorization: {self.opt.graph_use_color_buckets}')
 
         self.logger.info('RUN')
-        self.logger.info(f'csv output: {self.opt.run_create_csv}')
+        self.logger.info(f'pipeline: {self.opt.run_pipeline}')
+        if self.opt.run_serve:
+            self.logger.info(f'graph server port: {self.opt.run_server_port}')
+        self.logger.debug(f'result cache: {self.opt.run_result_cache}')
+        self.logger.info(f'data output: {self.opt.run_create_csv} ({self.opt.run_output_format})')
         if self.opt.run_hard_copy_timestamp_granularity == 0:
             timestamp_format = 'days'
         elif self.opt.run_hard_copy_timestamp_granularity == 1:
@@ -98,14 +115,112 @@ class Processor():
 
     def run(self):
         start = datetime.utcnow()
+        run_start = time.perf_counter()
         self.logger.info(f'Start at {start}')
         self.log_settings()
-        if self.opt.set_mode == 'file':
-            df = self.tb.read_data_from_file()
+        if self.opt.run_profile:
+            self.run_profiled()
         else:
-            numbers = self.tb.generate_number_list()
-            df = self.tb.create_dataframe(numbers)
-            self.tb.plot_data(df)
+            self.run_pipeline()
         end = datetime.utcnow()
         self.logger.info(f'End at {end}')
         self.logger.info(f'Total time: {end-start}')
+        top_sites = self.log_memory_profile() if self.timer.memory is not None else None
+        if self.opt.run_report:
+            self.write_run_report(start, end, time.perf_counter() - run_start, top_sites)
+
+    def run_pipeline(self):
+        if self.opt.set_mode == 'file':
+            df, factor_batch = self.tb.read_data_from_file()
+            self.tb.plot_data(df, factor_batch)
+        elif self.opt.run_pipeline == 'stream':
+            self.tb.stream_to_file()
+        else:
+            df, factor_batch = self.tb.compute_dataframe()
+            if self.opt.run_serve:
+                self.tb.save_hard_copy(df, factor_batch)
+                server.serve(server.prepare_view(self.tb, df, factor_batch), self.opt.run_server_port)
+            else:
+                self.tb.plot_data(df, factor_batch)
+
+    def run_profiled(self):
+        '''
+        Run the pipeline under cProfile and/or the stack sampler and save the profiles in the output folder:
+        .pstats for cProfile, collapsed stacks (flame graph input) for the sampler
+        '''
+        profile_mode = self.opt.run_profile
+        profiler = cProfile.Profile() if profile_mode in (True, 'cprofile') else None
+        sampler = None
+        if profile_mode in (True, 'sampler'):
+            sampler = profiling.StackSampler(self.opt.run_profile_sample_interval or profiling.DEFAULT_SAMPLE_INTERVAL)
+        if sampler is not None:
+            sampler.start()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            self.run_pipeline()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            if sampler is not None:
+                sampler.stop()
+
+        output_folder = 'output'
+        self.tb.prep_folder(output_folder, False)
+        profile_file_name = os.path.join(output_folder, self.tb.create_hard_copy_filename())
+        if profiler is not None:
+            profiler.dump_stats(profile_file_name + '.pstats')
+            self.logger.info(f'Profile saved as {profile_file_name}.pstats')
+        if sampler is not None:
+            sampler.write_collapsed(profile_file_name + '.collapsed')
+            self.logger.info(f'Stack samples saved as {profile_file_name}.collapsed')
+
+    def log_memory_profile(self):
+        '''
+        Log the peak and retained allocation of every stage and the top allocation sites, then stop tracing
+        Returns the top allocation sites
+        '''
+        megabyte = 2**20
+        memory_keys = ('peak_bytes', 'retained_bytes', 'peak_rss_bytes', 'retained_rss_bytes')
+        for name, stage in self.timer.stages.items():
+            # stages of worker processes are not tracked
+            measures = [f'{key[:-6]} {stage[key] / megabyte:9.1f} MB' for key in memory_keys if key in stage]
+            if measures:
+                self.logger.info(f'{name:<16} ' + '  '.join(measures))
+        top_sites = self.timer.memory.top_sites(self.opt.run_profile_memory_top or 10)
+        if top_sites:
+            self.logger.info('Top allocation sites:')
+        for site in top_sites:
+            self.logger.info(f'  {site}')
+        self.timer.memory.stop()
+        self.timer.memory = None
+        return top_sites
+
+    def write_run_report(self, start: datetime, end: datetime, total_seconds: float, top_sites=None):
+        '''
+        Log the time and throughput of every stage and save them as a json report in the output folder
+        '''
+        stages = self.timer.report()
+        for name, stage in stages.items():
+            rate = f'{stage["rows_per_second"]:,.0f} rows/s' if stage['rows_per_second'] else '-'
+            self.logger.debug(f'{name:<16} {stage["seconds"]:10.4f}s {stage["rows"]:>12,} rows  {rate}')
+        report = {
+            'start': start,
+            'end': end,
+            'total_seconds': total_seconds,
+            'settings': {
+                'set_mode': self.opt.set_mode,
+                'pipeline': self.opt.run_pipeline,
+                'workers': self.opt.run_workers,
+                'output_format': self.opt.run_output_format,
+                'graph_mode': self.opt.graph_mode,
+            },
+            'stages': stages,
+        }
+        if top_sites is not None:
+            report['top_allocation_sites'] = top_sites
+        output_folder = 'output'
+        self.tb.prep_folder(output_folder, False)
+        report_file_name = os.path.join(output_folder, self.tb.create_hard_copy_filename() + '_report.json')
+        run_report.write_report(report_file_name, report)
+        self.logger.info(f'Run report saved as {report_file_name}')
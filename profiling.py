@@ -0,0 +1,57 @@
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+# seconds between two stack samples
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler():
+    '''
+    Low-overhead statistical profiler: a background thread records the call stack of the thread
+    that started it at a fixed interval, and the samples are written as collapsed stacks
+    ('root;caller;callee count' per line), the input format of flame graph tools
+    '''
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL) -> None:
+        self.interval = interval
+        self.samples = Counter()
+        self.sampling = False
+        self.thread_id = None
+        self.sampler = None
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.sampling = True
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.sampling = False
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+    def _sample(self):
+        own_frame = sys._getframe()
+        while self.sampling:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not own_frame:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def write_collapsed(self, file_name: str):
+        with open(file_name, 'wt') as collapsed_file:
+            for stack, count in self.samples.most_common():
+                collapsed_file.write(f'{stack} {count}\n')
@@ -0,0 +1,79 @@
+import numpy as np
+
+
+def pixel_positions(values: np.ndarray, size: int, low: float = None, high: float = None) -> np.ndarray:
+    '''
+    Map values to pixel positions 0..size-1 over [low, high] (the value range by default)
+    '''
+    low = values.min() if low is None else low
+    high = values.max() if high is None else high
+    span = (high - low) or 1.0
+    positions = ((values - low) / span * size).astype(np.int64)
+    return np.clip(positions, 0, size - 1)
+
+
+def decimate(x, y, width: int, height: int, x_bounds=(None, None)) -> np.ndarray:
+    '''
+    Return the indices (ascending) of one representative row per occupied screen pixel
+    Every x-pixel column keeps one row for each y-pixel it covers, so the column's
+    minimum and maximum are always kept, and the plot looks the same at screen resolution
+    x_bounds sets the x range spread over the width (the data range by default)
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    rows = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if not len(rows):
+        return rows
+    cells = pixel_positions(x[rows], width, *x_bounds) * height + pixel_positions(y[rows], height)
+    _, first_rows = np.unique(cells, return_index=True)
+    return rows[np.sort(first_rows)]
+
+
+# CustomJS hover callback of the on-demand hover mode
+# computes the tooltip details of the hovered number from its prime factors, as metrics.compute_metrics does
+HOVER_DETAILS_CODE = '''
+const indices = cb_data.index.indices;
+if (indices.length == 0) {
+    return;
+}
+const row = indices[0];
+const offsets = offset_source.data['offsets'];
+const factors = Array.from(factor_source.data['values'].slice(offsets[row], offsets[row + 1]));
+const number = data.data['number'][row];
+const count = factors.length;
+const identity_factor = count ? factors[count - 1] : 0;
+const family_factors = factors.slice(0, -1);
+const family_product = family_factors.reduce((product, factor) => product * factor, 1);
+let ideal = number;
+if (count && factors[0] == identity_factor) {
+    ideal = identity_factor;
+} else if (count) {
+    ideal = Math.pow(number, 1 / count);
+}
+const deviation = count ? factors.reduce((total, factor) => total + Math.abs(factor - ideal), 0) / count : 0;
+const lines = [['number', number]];
+if (include_primes) {
+    lines.push(['prime', count == 1]);
+}
+lines.push(
+    ['factors', '[ ' + factors.join(', ') + ' ]'],
+    ['ideal factor value', ideal.toFixed(3)],
+    ['mean factor deviation', deviation.toFixed(3)],
+    ['anti-slope', (deviation > 0 ? number / deviation : 0).toFixed(3)],
+    ['attractor', family_product * count],
+    ['family factors', '[' + family_factors.join(', ') + ']'],
+    ['identity factor', identity_factor],
+    ['family product', family_product],
+    ['family', family_product]);
+details.text = lines.map(([name, value]) => '<b>' + name + '</b>: ' + value).join('<br>');
+'''
+
+
+def compact_array(values: np.ndarray) -> np.ndarray:
+    '''
+    Return integer values as int32 when they fit, as float64 otherwise
+    Both are sent to the browser as binary arrays; float64 is exact below 2^53
+    '''
+    if values.dtype != object and len(values) and values.min() >= -2**31 and values.max() < 2**31:
+        return values.astype(np.int32)
+    return values.astype(np.float64)
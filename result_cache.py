@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+from typing import Dict, List
+
+import storage
+from factorization import FactorBatch
+
+# bump when the computed columns or their encoding change, so that stale entries are never reused
+# 2: integers past int64 are stored as text instead of pickled object arrays
+RESULT_CACHE_VERSION = 2
+
+DEFAULT_RESULT_CACHE_SIZE_MB = 1024
+
+RESULT_EXTENSION = storage.OUTPUT_EXTENSIONS['npz']
+PARAMETERS_EXTENSION = '.json'
+
+
+def result_key(parameters: Dict) -> str:
+    '''
+    Content address of a number set: the hash of the parameters that determine it
+    '''
+    text = json.dumps({'version': RESULT_CACHE_VERSION, 'parameters': parameters}, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResultCache():
+    '''
+    Computed data columns and prime factors keyed by the hash of their number set parameters
+    Each entry is an npz file plus a json file of its parameters; the folder is kept under
+    max_bytes by evicting the least recently used entries (last use is the file modification time)
+    '''
+
+    def __init__(self, folder: str, max_bytes: int) -> None:
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.folder, key + extension)
+
+    def get(self, parameters: Dict):
+        '''
+        Return the cached (dataframe, factor batch) of the parameters, or None on a miss
+        '''
+        key = result_key(parameters)
+        file_name = self._path(key, RESULT_EXTENSION)
+        if not os.path.exists(file_name):
+            return None
+        os.utime(file_name)
+        return storage.read_results(file_name)
+
+    def put(self, parameters: Dict, dataframe, factor_batch: FactorBatch):
+        '''
+        Store the data of the parameters, then evict the least recently used entries over the size limit
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        key = result_key(parameters)
+        file_name = self._path(key, RESULT_EXTENSION)
+        # write under a temporary name so that a crash never leaves a truncated entry behind
+        temporary_name = self._path(key, '.tmp' + RESULT_EXTENSION)
+        storage.write_dataframe(dataframe, temporary_name, 'npz', factor_batch)
+        with open(self._path(key, PARAMETERS_EXTENSION), 'wt') as parameters_file:
+            json.dump(parameters, parameters_file, sort_keys=True)
+        os.replace(temporary_name, file_name)
+        self.evict()
+
+    def entries(self) -> List[Dict]:
+        '''
+        Return the parameters of every cached entry, most recently used first
+        '''
+        if not os.path.isdir(self.folder):
+            return []
+        entries = []
+        for file_name in os.listdir(self.folder):
+            key, extension = os.path.splitext(file_name)
+            if extension != PARAMETERS_EXTENSION or not os.path.exists(self._path(key, RESULT_EXTENSION)):
+                continue
+            with open(os.path.join(self.folder, file_name), 'rt') as parameters_file:
+                parameters = json.load(parameters_file)
+            entries.append((os.path.getmtime(self._path(key, RESULT_EXTENSION)), parameters))
+        return [parameters for _, parameters in sorted(entries, key=lambda entry: entry[0], reverse=True)]
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits in max_bytes
+        '''
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self.folder):
+            key, extension = os.path.splitext(file_name)
+            if extension != RESULT_EXTENSION or key.endswith('.tmp'):
+                continue
+            result_name = self._path(key, RESULT_EXTENSION)
+            parameters_name = self._path(key, PARAMETERS_EXTENSION)
+            size = os.path.getsize(result_name)
+            if os.path.exists(parameters_name):
+                size += os.path.getsize(parameters_name)
+            entries.append((os.path.getmtime(result_name), size, key))
+            total_size += size
+        for _, size, key in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            for extension in (RESULT_EXTENSION, PARAMETERS_EXTENSION):
+                if os.path.exists(self._path(key, extension)):
+                    os.remove(self._path(key, extension))
+            total_size -= size
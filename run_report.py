@@ -0,0 +1,185 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+import tracemalloc
+from typing import Dict, List
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# seconds between two resident set size samples of the memory profiler
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def resident_set_size() -> int:
+    '''
+    Return the resident set size of this process in bytes, or None where it cannot be read
+    '''
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', 'rt') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class MemoryTracker():
+    '''
+    Peak and retained memory per stage: the resident set size, sampled by a background thread,
+    and with trace_allocations the python allocations traced by tracemalloc
+    tracemalloc slows allocation-heavy code (text rendering, csv) several-fold; sampling alone costs next to nothing
+    Stages may nest
+    '''
+
+    def __init__(self, trace_allocations: bool = True) -> None:
+        self.trace_allocations = trace_allocations
+        self.started_tracing = trace_allocations and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        self.frames = []
+        self.rss_peak = resident_set_size()
+        self.sampling = self.rss_peak is not None
+        if self.sampling:
+            self.sampler = threading.Thread(target=self._sample_rss, daemon=True)
+            self.sampler.start()
+
+    def _sample_rss(self):
+        while self.sampling:
+            self.rss_peak = max(self.rss_peak, resident_set_size())
+            time.sleep(RSS_SAMPLE_INTERVAL)
+
+    def _measure(self):
+        '''
+        Return the current and peak allocation and resident set size since the last peak reset
+        '''
+        current, peak = tracemalloc.get_traced_memory() if self.trace_allocations else (0, 0)
+        rss = resident_set_size() if self.sampling else 0
+        return {'current': current, 'peak': peak, 'rss': rss, 'rss_peak': max(self.rss_peak or 0, rss)}
+
+    def enter(self):
+        measure = self._measure()
+        if self.frames:
+            # the outer stage keeps its peaks so far; the peaks restart for the inner stage
+            self.frames[-1]['peak'] = max(self.frames[-1]['peak'], measure['peak'])
+            self.frames[-1]['rss_peak'] = max(self.frames[-1]['rss_peak'], measure['rss_peak'])
+        if self.trace_allocations:
+            tracemalloc.reset_peak()
+        self.rss_peak = measure['rss']
+        self.frames.append({'current': measure['current'], 'peak': measure['current'],
+                            'rss': measure['rss'], 'rss_peak': measure['rss']})
+
+    def exit(self) -> Dict:
+        measure = self._measure()
+        frame = self.frames.pop()
+        peak = max(frame['peak'], measure['peak'])
+        rss_peak = max(frame['rss_peak'], measure['rss_peak'])
+        if self.frames:
+            self.frames[-1]['peak'] = max(self.frames[-1]['peak'], peak)
+            self.frames[-1]['rss_peak'] = max(self.frames[-1]['rss_peak'], rss_peak)
+        memory = {}
+        if self.trace_allocations:
+            memory['peak_bytes'] = peak - frame['current']
+            memory['retained_bytes'] = measure['current'] - frame['current']
+        if self.sampling:
+            memory['peak_rss_bytes'] = rss_peak
+            memory['retained_rss_bytes'] = measure['rss'] - frame['rss']
+        return memory
+
+    def top_sites(self, count: int) -> List[str]:
+        '''
+        Return the source lines holding the most allocated memory right now (empty without tracing)
+        '''
+        if not self.trace_allocations:
+            return []
+        statistics = tracemalloc.take_snapshot().statistics('lineno')
+        return [str(statistic) for statistic in statistics[:count]]
+
+    def stop(self):
+        self.sampling = False
+        if self.started_tracing:
+            tracemalloc.stop()
+
+
+class StageRecord():
+    '''
+    Row count of a timed stage, set by the code inside the stage
+    '''
+
+    def __init__(self, rows: int = 0) -> None:
+        self.rows = rows
+
+
+class StageTimer():
+    '''
+    Accumulates wall time and row counts per pipeline stage, in the order the stages first run
+    '''
+
+    def __init__(self, memory: MemoryTracker = None) -> None:
+        self.stages = {}
+        self.memory = memory
+
+    def add(self, name: str, seconds: float, rows: int = 0, memory: Dict = None):
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'rows': 0})
+        stage['seconds'] += seconds
+        stage['rows'] += rows
+        # a stage that runs several times keeps its largest peaks and its total retained memory
+        for key, value in (memory or {}).items():
+            if key.startswith('peak'):
+                stage[key] = max(stage.get(key, 0), value)
+            else:
+                stage[key] = stage.get(key, 0) + value
+
+    def merge(self, stages: Dict):
+        '''
+        Add the stages of another timer, ex. one of a worker process
+        '''
+        for name, stage in stages.items():
+            self.add(name, stage['seconds'], stage['rows'])
+
+    @contextmanager
+    def stage(self, name: str, rows: int = 0):
+        '''
+        Time the enclosed block as (part of) a stage; the yielded record takes the row count
+        '''
+        record = StageRecord(rows)
+        if self.memory is not None:
+            self.memory.enter()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            memory = self.memory.exit() if self.memory is not None else None
+            self.add(name, seconds, record.rows, memory)
+
+    def iterate(self, name: str, iterable):
+        '''
+        Yield from iterable, timing the production of every item as the stage
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as record:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                record.rows = len(item)
+            yield item
+
+    def report(self) -> Dict:
+        '''
+        Return the stages with their time, rows and throughput
+        '''
+        return {name: dict(stage, rows_per_second=stage['rows'] / stage['seconds']
+                           if stage['rows'] and stage['seconds'] else None)
+                for name, stage in self.stages.items()}
+
+
+def write_report(file_name: str, report: Dict):
+    with open(file_name, 'wt') as report_file:
+        json.dump(report, report_file, indent=2, default=str)
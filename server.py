@@ -0,0 +1,108 @@
+'''
+Bokeh server app: explore a result set with zoom-dependent resampling
+Only the visible x-window is sent to the browser, decimated to screen resolution,
+so every zoom level shows full detail
+
+usage: python server.py <result file> [config file]
+   or: bokeh serve server.py --args <result file> [config file]
+'''
+from functools import partial
+import logging
+import sys
+import numpy as np
+
+from bokeh.application import Application
+from bokeh.application.handlers.function import FunctionHandler
+from bokeh.io import curdoc
+from bokeh.models import ColumnDataSource, Range1d
+from bokeh.server.server import Server
+
+import labels
+import rendering
+import storage
+from factorization import FactorBatch
+from utils import SettingsParser, ToolBox
+
+
+class ResamplingView():
+    '''
+    A result set sorted by number, answering x-window queries at screen resolution
+    '''
+
+    def __init__(self, toolbox: ToolBox, dataframe, factor_batch: FactorBatch) -> None:
+        self.toolbox = toolbox
+        order = np.argsort(dataframe['number'].to_numpy(dtype=np.float64), kind='stable')
+        self.dataframe = dataframe.iloc[order].reset_index(drop=True)
+        self.factor_batch = factor_batch.take(order)
+        y_value = labels.y_axis_values[toolbox.opt.graph_mode]
+        self.x = self.dataframe['number'].to_numpy(dtype=np.float64)
+        self.y = self.dataframe[y_value].to_numpy(dtype=np.float64)
+
+    def query(self, x_start: float, x_end: float):
+        '''
+        Return the data source columns of the rows visible in [x_start, x_end]
+        '''
+        first = np.searchsorted(self.x, x_start, side='left')
+        last = np.searchsorted(self.x, x_end, side='right')
+        rows = first + rendering.decimate(self.x[first:last], self.y[first:last],
+                                          self.toolbox.opt.graph_width, self.toolbox.opt.graph_height,
+                                          x_bounds=(x_start, x_end))
+        window = storage.with_factor_text(self.dataframe.iloc[rows], self.factor_batch.take(rows))
+        return {column: window[column].to_numpy() for column in window.columns}
+
+
+def make_document(doc, view: ResamplingView):
+    x_start, x_end = float(view.x[0]), float(view.x[-1])
+    source = ColumnDataSource(data=view.query(x_start, x_end))
+    graph = view.toolbox.build_graph(source, x_range=Range1d(x_start, x_end))
+    pending = {'update': False}
+
+    def update():
+        pending['update'] = False
+        source.data = view.query(graph.x_range.start, graph.x_range.end)
+
+    def on_range_change(attr, old, new):
+        # start and end change together; resample once per range change
+        if not pending['update']:
+            pending['update'] = True
+            doc.add_next_tick_callback(update)
+
+    graph.x_range.on_change('start', on_range_change)
+    graph.x_range.on_change('end', on_range_change)
+    doc.add_root(graph)
+    doc.title = view.toolbox.create_graph_title()
+
+
+def load_view(file_name: str, config_file: str = 'config.ini') -> ResamplingView:
+    '''
+    Load a result file written in any output format and prepare it for serving
+    '''
+    toolbox = ToolBox(SettingsParser(config_file=config_file).get_settings())
+    toolbox.set_logger(logging.getLogger(__name__))
+    dataframe, factor_batch = storage.read_results(file_name)
+    return prepare_view(toolbox, dataframe, factor_batch)
+
+
+def prepare_view(toolbox: ToolBox, dataframe, factor_batch: FactorBatch) -> ResamplingView:
+    if toolbox.opt.graph_use_color_buckets:
+        dataframe = dataframe.assign(color_bucket=toolbox.get_color_bucket_column(
+            dataframe['number'].to_numpy(), dataframe['attractor'].to_numpy()))
+    return ResamplingView(toolbox, dataframe, factor_batch)
+
+
+def serve(view: ResamplingView, port: int):
+    '''
+    Serve the view on a local Bokeh server until interrupted
+    '''
+    server = Server({'/': Application(FunctionHandler(partial(make_document, view=view)))}, port=port)
+    server.start()
+    view.toolbox.logger.info(f'Serving graph on http://localhost:{port}/')
+    server.io_loop.start()
+
+
+if __name__.startswith('bokeh_app'):
+    make_document(curdoc(), load_view(*sys.argv[1:3]))
+
+if __name__ == '__main__':
+    view = load_view(*sys.argv[1:3])
+    serve(view, view.toolbox.opt.run_server_port or 5006)
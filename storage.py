@@ -0,0 +1,258 @@
+import numpy as np
+import pandas as pd
+
+from factorization import FactorBatch, integer_array
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as pf
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pf = None
+    pq = None
+
+OUTPUT_EXTENSIONS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'feather': '.feather',
+    'npz': '.npz',
+}
+
+PARQUET_COMPRESSION = 'zstd'
+
+# columns that hold integers, possibly past int64
+INTEGER_COLUMNS = ('number', 'identity_factor', 'family_product', 'family', 'attractor')
+
+# removed from the text factor lists before parsing
+BRACKETS = str.maketrans('', '', '[]')
+
+# column types of the csv output
+CSV_DTYPES = {
+    'number': np.int64,
+    'is_prime': str,
+    'prime_factors': str,
+    'ideal': np.float64,
+    'deviation': np.float64,
+    'anti_slope': np.float64,
+    'family_factors': str,
+    'identity_factor': np.int64,
+    'family_product': np.int64,
+    'family': np.int64,
+    'attractor': np.int64,
+    'color_bucket': str,
+}
+
+
+def require_pyarrow(output_format: str):
+    if pa is None:
+        raise ImportError(f'output format {output_format} requires pyarrow')
+
+
+def typed_columns(dataframe: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Convert the text-typed columns of the data to proper dtypes for the binary formats
+    '''
+    columns = {}
+    for column in dataframe.columns:
+        values = dataframe[column]
+        if column == 'is_prime':
+            values = values == 'true'
+        elif column == 'color_bucket':
+            values = values.astype(np.int64)
+        elif values.dtype == object and len(values) and isinstance(values.iloc[0], (int, np.integer)):
+            # numbers past int64 are kept as text
+            try:
+                values = values.astype(np.int64)
+            except OverflowError:
+                values = values.astype(str)
+        columns[column] = values
+    return pd.DataFrame(columns)
+
+
+def npz_array(values) -> np.ndarray:
+    '''
+    Return values as an array np.savez stores without pickling: integers past int64 become fixed-width text
+    '''
+    values = np.asarray(values)
+    if values.dtype == object:
+        return values.astype(str)
+    return values
+
+
+def with_factor_text(dataframe: pd.DataFrame, factor_batch: FactorBatch) -> pd.DataFrame:
+    '''
+    Return a copy of the data with the prime_factors and family_factors columns rendered as text,
+    in their original places
+    '''
+    dataframe = dataframe.copy()
+    dataframe.insert(dataframe.columns.get_loc('ideal'), 'prime_factors', factor_batch.render())
+    dataframe.insert(dataframe.columns.get_loc('identity_factor'), 'family_factors',
+                     factor_batch.render(drop_last=True, bookends=('[', ']')))
+    return dataframe
+
+
+def arrow_table(dataframe: pd.DataFrame, factor_batch: FactorBatch):
+    '''
+    Build an arrow table of the typed data with prime_factors as a list<int64> column
+    over the flat factor values and offsets (family_factors is the same list without its last entry)
+    '''
+    table = pa.Table.from_pandas(typed_columns(dataframe), preserve_index=False)
+    if factor_batch.values.dtype == object:
+        prime_factors = pa.array(factor_batch.render())
+    else:
+        prime_factors = pa.ListArray.from_arrays(pa.array(factor_batch.offsets), pa.array(factor_batch.values))
+    return table.add_column(table.schema.get_field_index('ideal'), 'prime_factors', prime_factors)
+
+
+def write_dataframe(dataframe: pd.DataFrame, file_name: str, output_format: str, factor_batch: FactorBatch):
+    '''
+    Write the data in one of the OUTPUT_EXTENSIONS formats
+    Factors are rendered as text only for csv; binary formats keep the flat values plus offsets
+    '''
+    if output_format == 'csv':
+        with_factor_text(dataframe, factor_batch).to_csv(file_name)
+    elif output_format == 'parquet':
+        require_pyarrow(output_format)
+        pq.write_table(arrow_table(dataframe, factor_batch), file_name, compression=PARQUET_COMPRESSION)
+    elif output_format == 'feather':
+        require_pyarrow(output_format)
+        pf.write_feather(arrow_table(dataframe, factor_batch), file_name)
+    elif output_format == 'npz':
+        arrays = {column: npz_array(values.to_numpy()) for column, values in typed_columns(dataframe).items()}
+        arrays['prime_factors_values'] = npz_array(factor_batch.values)
+        arrays['prime_factors_offsets'] = factor_batch.offsets
+        np.savez(file_name, **arrays)
+    else:
+        raise ValueError(f'Unknown output format: {output_format}')
+
+
+class ChunkWriter():
+    '''
+    Appends data chunks to a single output file
+    npz cannot be appended to and is not supported
+    '''
+
+    def __init__(self, file_name: str, output_format: str) -> None:
+        if output_format not in ('csv', 'parquet', 'feather'):
+            raise ValueError(f'Output format {output_format} cannot be written in chunks')
+        if output_format != 'csv':
+            require_pyarrow(output_format)
+        self.file_name = file_name
+        self.output_format = output_format
+        self.rows_written = 0
+        self.writer = None
+
+    def write(self, dataframe: pd.DataFrame, factor_batch: FactorBatch):
+        if self.output_format == 'csv':
+            with_factor_text(dataframe, factor_batch).to_csv(
+                self.file_name, mode='w' if self.rows_written == 0 else 'a', header=self.rows_written == 0)
+        else:
+            table = arrow_table(dataframe, factor_batch)
+            if self.writer is None:
+                if self.output_format == 'parquet':
+                    self.writer = pq.ParquetWriter(self.file_name, table.schema,
+                                                   compression=PARQUET_COMPRESSION)
+                else:
+                    self.writer = pa.ipc.new_file(self.file_name, table.schema)
+            self.writer.write_table(table)
+        self.rows_written += len(dataframe)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def untyped_columns(dataframe: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Undo typed_columns: restore the text columns used in memory and python integers past int64
+    '''
+    columns = {}
+    for column in dataframe.columns:
+        values = dataframe[column]
+        if column == 'is_prime':
+            values = np.where(values.to_numpy(dtype=bool), 'true', 'false')
+        elif column == 'color_bucket':
+            values = values.astype(str)
+        elif column in INTEGER_COLUMNS and values.dtype.kind not in 'iu':
+            values = integer_array([int(value) for value in values])
+        columns[column] = values
+    return pd.DataFrame(columns)
+
+
+def parse_factor_text(numbers: np.ndarray, factor_text: pd.Series) -> FactorBatch:
+    '''
+    Parse factor lists rendered as text ('[ 2, 3 ]') into a factor batch in one pass
+    '''
+    factorized = factor_text.str.contains(r'\d', regex=True).to_numpy(dtype=bool)
+    counts = np.where(factorized, factor_text.str.count(',').to_numpy() + 1, 0)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    value_text = ','.join(factor_text[factorized].tolist()).translate(BRACKETS)
+    if numbers.dtype == object:
+        # factors past int64 are parsed as python integers
+        values = integer_array([int(value) for value in value_text.split(',')] if value_text else [])
+    else:
+        values = np.fromstring(value_text, dtype=np.int64, sep=',') if value_text else np.empty(0, dtype=np.int64)
+    return FactorBatch(numbers, values, offsets)
+
+
+def read_csv_results(file_name: str):
+    '''
+    Read a result set written as csv, with explicit column types
+    Returns the data without the text factor columns and the factor batch of prime_factors
+    '''
+    try:
+        dataframe = pd.read_csv(file_name, index_col=0, dtype=CSV_DTYPES, float_precision='round_trip')
+    except OverflowError:
+        # integers past int64 are read as text and kept as python integers
+        dataframe = pd.read_csv(file_name, index_col=0, float_precision='round_trip',
+                                dtype=dict(CSV_DTYPES, **{column: str for column in INTEGER_COLUMNS}))
+        for column in INTEGER_COLUMNS:
+            dataframe[column] = integer_array([int(value) for value in dataframe[column]])
+    for column in INTEGER_COLUMNS:
+        # integers between 2^63 and 2^64 are read as uint64 without an OverflowError
+        if column in dataframe.columns and dataframe[column].dtype == np.uint64:
+            dataframe[column] = integer_array(dataframe[column].tolist())
+    dataframe = dataframe.reset_index(drop=True)
+    factor_text = dataframe.pop('prime_factors')
+    dataframe = dataframe.drop(columns='family_factors')
+    return dataframe, parse_factor_text(integer_array(dataframe['number']), factor_text)
+
+
+def read_results(file_name: str):
+    '''
+    Read a result set written in one of the OUTPUT_EXTENSIONS formats
+    Returns the data and the factor batch of its prime_factors column
+    '''
+    if file_name.endswith(OUTPUT_EXTENSIONS['csv']):
+        return read_csv_results(file_name)
+    if file_name.endswith(OUTPUT_EXTENSIONS['npz']):
+        with np.load(file_name) as arrays:
+            columns = {column: arrays[column] for column in arrays.files
+                       if not column.startswith('prime_factors_')}
+            values = arrays['prime_factors_values']
+            offsets = arrays['prime_factors_offsets']
+        if values.dtype.kind == 'U':
+            # factors past int64 are stored as text
+            values = integer_array([int(value) for value in values])
+        dataframe = untyped_columns(pd.DataFrame(columns))
+        return dataframe, FactorBatch(integer_array(dataframe['number']), values, offsets)
+
+    require_pyarrow('parquet / feather')
+    if file_name.endswith(OUTPUT_EXTENSIONS['parquet']):
+        table = pq.read_table(file_name)
+    elif file_name.endswith(OUTPUT_EXTENSIONS['feather']):
+        table = pf.read_table(file_name)
+    else:
+        raise ValueError(f'Unknown result file format: {file_name}')
+    prime_factors = table.column('prime_factors').combine_chunks()
+    dataframe = untyped_columns(table.drop(['prime_factors']).to_pandas())
+    numbers = integer_array(dataframe['number'])
+    if pa.types.is_list(prime_factors.type):
+        offsets = prime_factors.offsets.to_numpy().astype(np.int64)
+        values = prime_factors.values.to_numpy()[offsets[0]:offsets[-1]].astype(np.int64)
+        return dataframe, FactorBatch(numbers, values, offsets - offsets[0])
+    # factors past int64 are stored as text
+    return dataframe, parse_factor_text(numbers, prime_factors.to_pandas())
@@ -1,6 +1,9 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from configparser import ConfigParser
 from datetime import datetime
 import json
+import logging
 import math
 import os
 from typing import Dict, List
@@ -9,17 +12,34 @@ import numpy as np
 import re
 import pandas as pd
 
-from bokeh.models import ColumnDataSource, CategoricalColorMapper
+from bokeh.layouts import column
+from bokeh.models import ColumnDataSource, CategoricalColorMapper, CustomJS, Div
 from bokeh.plotting import figure, show
+from bokeh.resources import CDN, INLINE
+from bokeh.io import save
 from bokeh import models as models
 from bokeh.palettes import Magma, Inferno, Plasma, Viridis, Cividis, Turbo
 
 import labels
+import metrics
+import primes
+import rendering
+import result_cache
+import run_report
+import storage
+import factorization
+from factorization import FactorBatch
+
+# default number of rows per chunk in parallel mode
+DEFAULT_CHUNK_SIZE = 1000000
 
 
 class ToolBox():
-    def __init__(self, options) -> None:
+    def __init__(self, options, timer: run_report.StageTimer = None) -> None:
         self.opt = options
+        self.timer = timer if timer is not None else run_report.StageTimer()
+        self.prime_table = None
+        self.factorization_backends = {}
 
     def set_logger(self, logger):
         self.logger = logger
@@ -30,17 +50,28 @@ class ToolBox():
         previous_base = int(np.floor(number_of_groups**(1/11)))
         return previous_base + 1
 
-    def get_family_buckets(self, families, color_base):
-        color_buckets = {}
+    def get_bucket_ends(self, number_of_groups: int, color_base: int) -> np.ndarray:
+        '''
+        Return the end of every color bucket in the sorted groups; bucket k holds color_base**(k - 1) groups
+        '''
+        bucket_ends = []
+        bucket_end = 0
         power = 0
-        while len(families) >= 1:
-            next_cut_off = color_base**power
-            bucket_index = power + 1
-            if not bucket_index in color_buckets.keys():
-                color_buckets[bucket_index] = []
-            color_buckets[bucket_index].extend(families[:next_cut_off])
-            families = families[next_cut_off:]
+        while bucket_end < number_of_groups:
+            bucket_end += color_base**power
+            bucket_ends.append(min(bucket_end, number_of_groups))
             power = power + 1
+        return np.array(bucket_ends, dtype=np.int64)
+
+    def get_family_buckets(self, families: np.ndarray, color_base):
+        '''
+        Split the sorted unique families into color buckets (views, no copies)
+        '''
+        bucket_ends = self.get_bucket_ends(len(families), color_base)
+        bucket_starts = np.concatenate(([0], bucket_ends[:-1]))
+        color_buckets = {}
+        for bucket_index, (start, end) in enumerate(zip(bucket_starts, bucket_ends), start=1):
+            color_buckets[bucket_index] = families[start:end]
         return color_buckets
 
     def prep_folder(self, folder_name: str, reset_folder: bool):
@@ -62,175 +93,505 @@ class ToolBox():
     def generate_number_list(self):
         self.logger.info('Generating numbers')
         number_list = []
-        if self.opt.set_mode == 'family':
-            self.logger.debug('Processing families')
-            number_list = self.generate_number_families()
-        elif self.opt.set_mode == 'range':
-            self.logger.debug('Processing range')
-            number_list = self.generate_continuous_number_list()
-        else:
-            self.logger.debug('Processing file - NOT IMPLEMENTED YET')
+        with self.timer.stage('generation') as stage:
+            if self.opt.set_mode == 'family':
+                self.logger.debug('Processing families')
+                number_list = self.generate_number_families()
+            elif self.opt.set_mode == 'range':
+                self.logger.debug('Processing range')
+                number_list = self.generate_continuous_number_list()
+            else:
+                self.logger.debug('Processing file - NOT IMPLEMENTED YET')
+            stage.rows = len(number_list)
         self.logger.debug(f'Numbers generated ({len(number_list)})')
 
         return number_list
 
-    def generate_continuous_number_list(self):
+    def iterate_number_chunks(self, chunk_size: int):
         '''
-        Generate a number of Number objects with values in a range, specified in config
+        Yield the numbers specified in config in chunks of about chunk_size rows
+        Range mode yields int64 arrays, family mode yields factor batches
         '''
-        lowerbound = self.opt.set_range_min
-        upperbound = self.opt.set_range_max
+        if self.opt.set_mode == 'family':
+            yield from self.iterate_number_families(chunk_size)
+            return
+        pending = []
+        pending_size = 0
+        for segment in self.iterate_continuous_number_segments():
+            pending.append(segment)
+            pending_size += len(segment)
+            if pending_size >= chunk_size:
+                yield np.concatenate(pending)
+                pending = []
+                pending_size = 0
+        if pending:
+            yield np.concatenate(pending)
+
+    def generate_continuous_number_list(self, lowerbound: int = None, upperbound: int = None):
+        '''
+        Generate an int64 array of the numbers in a range, specified in config unless given
+        '''
+        segments = list(self.iterate_continuous_number_segments(lowerbound, upperbound))
+        if not segments:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(segments)
+
+    def iterate_continuous_number_segments(self, lowerbound: int = None, upperbound: int = None):
+        '''
+        Yield the numbers in a range, specified in config unless given, one sieve segment at a time
+        '''
+        if lowerbound is None:
+            lowerbound = self.opt.set_range_min
+        if upperbound is None:
+            upperbound = self.opt.set_range_max
         if lowerbound < 2:
             lowerbound = 2
-        number_list = []
-        for number in range(lowerbound, upperbound + 1):
-            if pp.isprime(number) and not self.opt.set_include_primes:
-                continue
-            number_list.append(number)
-        return number_list
+        segment_size = self.get_segment_size()
+        yield from primes.range_number_segments(lowerbound, upperbound, self.opt.set_include_primes, segment_size,
+                                                prime_table=self.get_prime_table())
 
     def generate_number_families(self):
         '''
-        Generate a list of Number objects
-        from the family definitions specified in config
+        Generate the numbers of the families specified in config as a factor batch
+        Every number is family_product * identity_factor, so its factors are known without factorization
+        The identity primes are generated once per run and shared by all families
         '''
-        number_list = []
-        for family in self.opt.set_families:
-            family_product = int(np.prod(family))
-            if self.opt.set_identity_factor_mode == 'count':
+        family_factor_lists = self.get_family_factor_lists()
+        identity_primes, first_indices, identity_factor_count = self.get_identity_primes()
+        identity_factors = identity_primes[first_indices[:, None] + np.arange(identity_factor_count)]
+        family_batches = factorization.family_factor_batches(
+            family_factor_lists, identity_factors)
+
+        leading_batches = self.get_leading_family_batches(family_factor_lists)
+        if leading_batches:
+            family_batches = [batch for batches in zip(leading_batches, family_batches) for batch in batches]
+        return factorization.concatenate_batches(family_batches)
+
+    def iterate_number_families(self, chunk_size: int):
+        '''
+        Yield the numbers of the families specified in config as factor batches of at most chunk_size rows
+        '''
+        family_factor_lists = self.get_family_factor_lists()
+        identity_primes, first_indices, identity_factor_count = self.get_identity_primes()
+        leading_batches = self.get_leading_family_batches(family_factor_lists)
+        for family_index, family_factors in enumerate(family_factor_lists):
+            if leading_batches:
+                yield leading_batches[family_index]
+            first_index = int(first_indices[family_index])
+            for start in range(0, identity_factor_count, chunk_size):
+                stop = min(start + chunk_size, identity_factor_count)
+                identity_slice = identity_primes[first_index + start:first_index + stop]
+                yield factorization.family_factor_batches([family_factors], identity_slice[None, :])[0]
+
+    def get_family_factor_lists(self) -> List[List[int]]:
+        family_products = [math.prod(family) for family in self.opt.set_families]
+        return self.factorize_numbers(family_products).factor_lists()
+
+    def get_identity_primes(self):
+        '''
+        Return the identity primes shared by all families, the index of each family's first identity prime
+        in that array and the number of identity primes per family
+        In count mode the array starts at the smallest required prime
+        '''
+        if self.opt.set_identity_factor_mode == 'count':
+            identity_factor_count = self.opt.set_identity_factor_count
+            starts = []
+            for family in self.opt.set_families:
                 if self.opt.set_identity_factor_minimum_mode == 'family':
-                    largest_family_factor = family[-1]
-                    identity_prime_generator = pp.primes_above(
-                        largest_family_factor)
-                    first_identity_factor = next(identity_prime_generator)
+                    # first identity factor is the first prime above the largest family factor
+                    starts.append(family[-1] + 1)
                 elif self.opt.set_identity_factor_minimum_mode == 'origin':
-                    first_identity_factor = 2
-                    identity_prime_generator = pp.primes_above(
-                        first_identity_factor)
+                    starts.append(2)
                 else:
-                    first_identity_factor = self.opt.set_identity_factor_minimum_value
-                    identity_prime_generator = pp.primes_above(first_identity_factor)
-                    if not pp.isprime(first_identity_factor):
-                        first_identity_factor = next(identity_prime_generator)
-                number_of_families = self.opt.set_identity_factor_count
-            else:
-                first_identity_factor = self.opt.set_identity_factor_range_min
-                number_of_families = pp.prime_count(
-                    self.opt.set_identity_factor_range_max) - pp.prime_count(self.opt.set_identity_factor_range_min)
-                identity_prime_generator = pp.primes_above(
-                    first_identity_factor)
-
-            number_list.append(family_product * first_identity_factor)
-            for count in range(number_of_families - 1):
-                next_identity_factor = next(identity_prime_generator)
-                number_list.append(family_product * next_identity_factor)
-            
-        return number_list
+                    starts.append(self.opt.set_identity_factor_minimum_value)
+            starts = np.array(starts, dtype=np.int64)
+
+            first_start = int(starts.min())
+            identity_primes = self.find_primes_from(first_start, identity_factor_count)
+            first_indices = np.searchsorted(identity_primes, starts)
+            required_count = int(first_indices.max()) + identity_factor_count
+            if len(identity_primes) < required_count:
+                identity_primes = self.find_primes_from(first_start, required_count)
+            return identity_primes, first_indices, identity_factor_count
+
+        first_identity_factor = self.opt.set_identity_factor_range_min
+        identity_primes = self.find_primes_between(
+            first_identity_factor + 1, self.opt.set_identity_factor_range_max)
+        # one family fewer than the primes in (range min, range max]: the largest prime is left out
+        identity_primes = identity_primes[:max(len(identity_primes) - 1, 0)]
+        if factorization.is_prime(first_identity_factor):
+            identity_primes = np.insert(identity_primes, 0, first_identity_factor)
+        first_indices = np.zeros(len(self.opt.set_families), dtype=np.int64)
+        return identity_primes, first_indices, len(identity_primes)
+
+    def get_leading_family_batches(self, family_factor_lists: List[List[int]]) -> List[FactorBatch]:
+        '''
+        In range mode the range minimum leads every family even if it is not prime;
+        those numbers are factorized and returned as one batch per family (empty list if not needed)
+        '''
+        first_identity_factor = self.opt.set_identity_factor_range_min
+        if self.opt.set_identity_factor_mode == 'count' or factorization.is_prime(first_identity_factor):
+            return []
+        first_factors = self.factorize_numbers([first_identity_factor]).factor_lists()[0]
+        leading_batches = []
+        for family_factors in family_factor_lists:
+            leading_batches.append(FactorBatch.from_lists(
+                [math.prod(family_factors) * first_identity_factor], [sorted(family_factors + first_factors)]))
+        return leading_batches
+
+    def get_segment_size(self) -> int:
+        return self.opt.run_sieve_segment_size or primes.DEFAULT_SEGMENT_SIZE
+
+    def get_prime_table(self):
+        '''
+        Return the persistent prime table, or None if it is disabled in config
+        '''
+        table_file_name = self.opt.run_prime_table_file
+        if not table_file_name or table_file_name == 'none':
+            return None
+        if self.prime_table is None:
+            segment_size = self.get_segment_size()
+            self.prime_table = primes.PrimeTable(table_file_name, segment_size)
+            self.logger.debug(f'Prime table loaded ({len(self.prime_table.primes)} primes)')
+        return self.prime_table
+
+    def find_primes_between(self, lowerbound: int, upperbound: int) -> np.ndarray:
+        prime_table = self.get_prime_table()
+        if prime_table is not None:
+            return prime_table.primes_between(lowerbound, upperbound)
+        segment_size = self.get_segment_size()
+        return primes.primes_between(lowerbound, upperbound, segment_size)
+
+    def find_primes_from(self, start: int, count: int) -> np.ndarray:
+        prime_table = self.get_prime_table()
+        if prime_table is not None:
+            return prime_table.primes_from(start, count)
+        segment_size = self.get_segment_size()
+        return primes.primes_from(start, count, segment_size)
 
     def read_data_from_file(self):
+        '''
+        Load a previous output file (csv, parquet, feather or npz) for plotting without recomputation
+        Color buckets are assigned again from the attractors, with the current graph settings
+        Returns the data and the factor batch of its rows
+        '''
         file_name = self.opt.set_csv_file_name
         try:
-            with open(file_name, mode='w') as file:
-                df = pd.read_csv(file)
+            df, factor_batch = storage.read_results(file_name)
         except Exception as e:
-            self.logger.error(f'Could not read csv input file: {e}')
+            self.logger.error(f'Could not read input file: {e}')
             raise e
+        self.logger.debug(f'Read {len(df)} rows from {file_name}')
+        return self.assign_color_buckets(df), factor_batch
+
+    def assign_color_buckets(self, df):
+        '''
+        (Re)assign the color bucket column of loaded data from its attractors, with the current graph settings
+        '''
+        if 'color_bucket' in df.columns:
+            df = df.drop(columns='color_bucket')
+        if self.opt.graph_use_color_buckets:
+            df['color_bucket'] = self.get_color_bucket_column(df['number'].to_numpy(), df['attractor'].to_numpy())
         return df
 
+    def compute_dataframe(self):
+        '''
+        Return the data of the number set specified in config and the factor batch of its rows,
+        from the result cache when it holds them
+        '''
+        cache = self.get_result_cache()
+        parameters = self.get_number_set_parameters()
+        if cache is not None:
+            with self.timer.stage('cache_read') as stage:
+                cached = cache.get(parameters)
+                stage.rows = len(cached[0]) if cached is not None else 0
+            if cached is not None:
+                df, factor_batch = cached
+                self.logger.info(f'Data loaded from the result cache ({len(df)} rows)')
+                return self.assign_color_buckets(df), factor_batch
+
+        extended = None
+        if cache is not None and self.opt.set_mode == 'range' and self.opt.run_incremental:
+            extended = self.extend_cached_range(cache, parameters)
+        if extended is not None:
+            df, factor_batch = extended
+        else:
+            numbers = self.generate_number_list()
+            df, factor_batch = self.create_dataframe(numbers)
+        if cache is not None:
+            with self.timer.stage('cache_write', rows=len(df)):
+                cache.put(parameters, df.drop(columns='color_bucket', errors='ignore'), factor_batch)
+            self.logger.debug('Data stored in the result cache')
+        return df, factor_batch
+
+    def extend_cached_range(self, cache: result_cache.ResultCache, parameters: Dict):
+        '''
+        Build the data of the configured range from the cached range that overlaps it most,
+        computing only the numbers below and above it; returns (dataframe, factor batch),
+        or None if no cached range overlaps
+        '''
+        lowerbound = max(self.opt.set_range_min, 2)
+        upperbound = self.opt.set_range_max
+        best_overlap = 0
+        for entry in cache.entries():
+            if entry['mode'] != 'range' or entry['include_primes'] != parameters['include_primes']:
+                continue
+            overlap = min(upperbound, entry['range'][1]) - max(lowerbound, entry['range'][0], 2) + 1
+            if overlap > best_overlap:
+                best_overlap, best_entry = overlap, entry
+        if not best_overlap:
+            return None
+
+        cached_df, cached_factors = cache.get(best_entry)
+        covered_min = max(lowerbound, best_entry['range'][0], 2)
+        covered_max = min(upperbound, best_entry['range'][1])
+        self.logger.info(f'Reusing cached range {covered_min}..{covered_max}')
+        numbers = cached_df['number'].to_numpy()
+        first = np.searchsorted(numbers, covered_min)
+        last = np.searchsorted(numbers, covered_max, side='right')
+
+        # parts in ascending order: below the cached range, cached rows, above the cached range
+        parts = [self.compute_range_dataframe(lowerbound, covered_min - 1),
+                 (cached_df.iloc[first:last], cached_factors[first:last]),
+                 self.compute_range_dataframe(covered_max + 1, upperbound)]
+        parts = [part for part in parts if part is not None]
+        factor_batch = factorization.concatenate_batches([part_factors for _, part_factors in parts])
+        with self.timer.stage('dataframe', rows=len(factor_batch)):
+            df = pd.concat([part_df for part_df, _ in parts], ignore_index=True)
+        self.logger.debug(f'Data collated')
+        return self.assign_color_buckets(df), factor_batch
+
+    def compute_range_dataframe(self, lowerbound: int, upperbound: int):
+        '''
+        Compute the data of the numbers in [lowerbound, upperbound]; returns (dataframe, factor batch),
+        or None if the range holds no numbers
+        '''
+        numbers = self.generate_continuous_number_list(lowerbound, upperbound)
+        if not len(numbers):
+            return None
+        self.logger.info(f'Computing range {lowerbound}..{upperbound} ({len(numbers)} numbers)')
+        data_dict = self.compute_columns(numbers)
+        factor_batch = data_dict.pop('prime_factors')
+        return pd.DataFrame(data_dict), factor_batch
+
+    def get_result_cache(self):
+        '''
+        Return the result cache, or None if it is disabled in config
+        '''
+        if not self.opt.run_result_cache:
+            return None
+        folder = self.opt.run_result_cache_folder or 'cache/results'
+        size_mb = self.opt.run_result_cache_size_mb or result_cache.DEFAULT_RESULT_CACHE_SIZE_MB
+        return result_cache.ResultCache(folder, size_mb * 2**20)
+
+    def get_number_set_parameters(self) -> Dict:
+        '''
+        Return the settings that determine the number set and its data columns
+        '''
+        parameters = {'mode': self.opt.set_mode, 'include_primes': bool(self.opt.set_include_primes)}
+        if self.opt.set_mode == 'family':
+            parameters['families'] = self.opt.set_families
+            parameters['identity_factor_mode'] = self.opt.set_identity_factor_mode
+            if self.opt.set_identity_factor_mode == 'range':
+                parameters['identity_factor_range'] = [self.opt.set_identity_factor_range_min,
+                                                       self.opt.set_identity_factor_range_max]
+            else:
+                parameters['identity_factor_minimum_mode'] = self.opt.set_identity_factor_minimum_mode
+                if self.opt.set_identity_factor_minimum_mode == 'value':
+                    parameters['identity_factor_minimum_value'] = self.opt.set_identity_factor_minimum_value
+                parameters['identity_factor_count'] = self.opt.set_identity_factor_count
+        elif self.opt.set_mode == 'range':
+            parameters['range'] = [self.opt.set_range_min, self.opt.set_range_max]
+        return parameters
+
     def create_dataframe(self, number_list: List[int]):
+        '''
+        Return the data of the numbers and the factor batch of its rows
+        '''
+        data_dict = self.compute_columns(number_list)
+        # factors stay in flat values plus offsets form; text is rendered only for csv and tooltips
+        factor_batch = data_dict.pop('prime_factors')
+        if self.opt.graph_use_color_buckets:
+            data_dict['color_bucket'] = self.get_color_bucket_column(data_dict['number'], data_dict['attractor'])
+
+        with self.timer.stage('dataframe', rows=len(factor_batch)):
+            df = pd.DataFrame(data_dict)
+            df.reset_index()
+        self.logger.debug(f'Data collated')
 
-        def get_ideal_factor(number: int, factors) -> float:
-            return math.pow(number, 1/len(factors))
+        return df, factor_batch
 
-        def get_mean_deviation(prime_factors: List[int], ideal_factor: float) -> float:
-            deviations_sum = 0
-            for prime_factor in prime_factors:
-                deviations_sum += abs(prime_factor - ideal_factor)
-            mean_deviation = deviations_sum / len(prime_factors)
-            return mean_deviation
+    def compute_columns(self, number_list) -> Dict:
+        '''
+        Compute the data columns of all numbers, split into chunks over worker processes if configured
+        The chunks are concatenated in order, so the result is the same as in a single process
+        '''
+        chunk_size = self.get_chunk_size()
+        if self.get_worker_count() <= 1 or len(number_list) <= chunk_size:
+            return self.compute_chunk_columns(number_list)
 
-        def get_antisplope(number, mean_deviation):
-            if mean_deviation > 0:
-                return number / mean_deviation
+        if not isinstance(number_list, FactorBatch):
+            number_list = factorization.integer_array(number_list)
+        chunks = [number_list[start:start + chunk_size] for start in range(0, len(number_list), chunk_size)]
+        chunk_columns = list(self.iterate_computed_chunks(chunks))
+
+        data_dict = {}
+        for column in chunk_columns[0].keys():
+            parts = [columns[column] for columns in chunk_columns]
+            if isinstance(parts[0], FactorBatch):
+                data_dict[column] = factorization.concatenate_batches(parts)
             else:
-                return 0
+                data_dict[column] = np.concatenate(parts)
+        return data_dict
+
+    def iterate_computed_chunks(self, chunks):
+        '''
+        Yield the data columns of each chunk, in order
+        With several workers only a bounded number of chunks is in flight at any time
+        '''
+        workers = self.get_worker_count()
+        if workers <= 1:
+            for chunk in chunks:
+                yield self.compute_chunk_columns(chunk)
+            return
+        self.logger.debug(f'Computing chunks on {workers} workers')
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(self.opt,)) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(compute_worker_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    yield self.collect_worker_chunk(pending.popleft())
+            while pending:
+                yield self.collect_worker_chunk(pending.popleft())
+
+    def collect_worker_chunk(self, future) -> Dict:
+        '''
+        Return the data columns of a worker chunk, adding the worker's stage timings to this run's
+        Worker stages sum the time of all workers, so they can exceed the wall time of the run
+        '''
+        data_dict, worker_stages = future.result()
+        self.timer.merge(worker_stages)
+        return data_dict
+
+    def get_worker_count(self) -> int:
+        workers = self.opt.run_workers or 1
+        if workers == 'auto':
+            workers = os.cpu_count()
+        return workers
 
-        def get_antislope_attractor(factors):
-            return int(np.prod(factors[:-1])) * len(factors)
+    def get_chunk_size(self) -> int:
+        return self.opt.run_chunk_size or DEFAULT_CHUNK_SIZE
+
+    def stream_to_file(self):
+        '''
+        Streaming pipeline: generate, compute and append the data to the output file one chunk at a time,
+        so that memory use does not grow with the size of the number set
+        Color buckets need the whole set and are left to plotting
+        '''
+        output_folder = 'output'
+        self.prep_folder(output_folder, self.opt.run_reset_output_data)
+        output_format = self.get_output_format()
+        output_file_name = os.path.join(
+            output_folder, self.create_hard_copy_filename() + storage.OUTPUT_EXTENSIONS[output_format])
+        writer = storage.ChunkWriter(output_file_name, output_format)
+        chunks = self.timer.iterate('generation', self.iterate_number_chunks(self.get_chunk_size()))
+        try:
+            for data_dict in self.iterate_computed_chunks(chunks):
+                rows_written = writer.rows_written
+                factor_batch = data_dict.pop('prime_factors')
+                with self.timer.stage('dataframe', rows=len(factor_batch)):
+                    chunk_df = pd.DataFrame(data_dict, index=pd.RangeIndex(
+                        rows_written, rows_written + len(data_dict['number'])))
+                with self.timer.stage(f'{output_format}_write', rows=len(factor_batch)):
+                    writer.write(chunk_df, factor_batch)
+                self.logger.debug(f'{writer.rows_written} rows written')
+        finally:
+            writer.close()
+        self.logger.info(f'Data streamed to {output_file_name} ({writer.rows_written} rows)')
+        return output_file_name
+
+    def compute_chunk_columns(self, number_list) -> Dict:
+        '''
+        Factorize a chunk of numbers (unless it already is a factor batch) and compute its data columns
+        '''
+        if isinstance(number_list, FactorBatch):
+            factor_batch = number_list
+        else:
+            factor_batch = self.factorize_numbers(number_list)
+        with self.timer.stage('metrics', rows=len(factor_batch)):
+            metric_columns = metrics.compute_metrics(factor_batch)
 
         # prep dictionary
         data_dict = {}
-        data_dict['number'] = []
+        data_dict['number'] = factor_batch.numbers
         if self.opt.set_include_primes:
-            data_dict['is_prime'] = []
-        data_dict['prime_factors'] = []
-        data_dict['ideal'] = []
-        data_dict['deviation'] = []
-        data_dict['anti_slope'] = []
-        data_dict['family_factors'] = []
-        data_dict['identity_factor'] = []
-        data_dict['family_product'] = []
-        data_dict['family'] = []
-        data_dict['attractor'] = []
-        if self.opt.graph_use_color_buckets:
-            data_dict['color_bucket'] = []
-        
-        self.attractors = []
-        # fill in dictionary
-        for number in number_list:
-            data_dict['number'].append(number)
-            if self.opt.set_include_primes:
-                data_dict['is_prime'].append(
-                    'true' if pp.isprime(number) else 'false')
-            factors = pp.factors(number)
-            data_dict['prime_factors'].append(
-                self.int_list_to_str(factors))
-            ideal_factor = get_ideal_factor(number, factors)
-            data_dict['ideal'].append(ideal_factor)
-            mean_deviation = get_mean_deviation(factors, ideal_factor)
-            data_dict['deviation'].append(mean_deviation)
-            anti_slope = get_antisplope(number, mean_deviation)
-            data_dict['anti_slope'].append(anti_slope)
-            anti_slope_attractor = get_antislope_attractor(factors)
-            data_dict['attractor'].append(anti_slope_attractor)
-            if number == 1:
-                data_dict['family_factors'].append(0)
-                data_dict['identity_factor'].append(0)
-                data_dict['family_product'].append(1)
-                data_dict['family'].append(1)
-                self.attractors.append(1)
+            data_dict['is_prime'] = np.where(
+                factor_batch.counts() == 1, 'true', 'false')
+        data_dict['prime_factors'] = factor_batch
+        data_dict['ideal'] = metric_columns['ideal']
+        data_dict['deviation'] = metric_columns['deviation']
+        data_dict['anti_slope'] = metric_columns['anti_slope']
+        data_dict['identity_factor'] = metric_columns['identity_factor']
+        data_dict['family_product'] = metric_columns['family_product']
+        data_dict['family'] = metric_columns['family_product']
+        data_dict['attractor'] = metric_columns['attractor']
+        return data_dict
+
+    def factorize_numbers(self, number_list) -> FactorBatch:
+        '''
+        Factorize a batch of numbers in one pass with the configured factorization backend
+        '''
+        numbers = factorization.integer_array(number_list)
+        largest_number = int(numbers.max()) if len(numbers) else 0
+        smallest_number = int(numbers.min()) if len(numbers) else 0
+        backend = self.get_factorization_backend(largest_number, smallest_number)
+        self.logger.debug(f'Factorizing {len(numbers)} numbers with the {backend.name} backend')
+        with self.timer.stage('factorization', rows=len(numbers)):
+            return backend.factorize(numbers)
+
+    def get_factorization_backend(self, largest_number: int, smallest_number: int = 0) -> factorization.FactorizationBackend:
+        '''
+        Return the backend set in config or, in auto mode, the one suited to the batch:
+        a segmented factor sieve for int64 batches spanning less than half their largest number
+        (chunks of stream mode and worker processes) while its base primes, up to sqrt(largest number),
+        stay within spf_table_limit; otherwise up to spf_table_limit a smallest-prime-factor table,
+        Pollard-Brent rho below 2^64 and arbitrary-precision Pollard-Brent rho above that
+        Backends are kept for the life of the toolbox, so the sieve's base primes are built once
+        '''
+        backend_name = self.opt.run_factorization_backend
+        if not backend_name or backend_name == 'auto':
+            spf_table_limit = self.opt.run_spf_table_limit or factorization.DEFAULT_SPF_TABLE_LIMIT
+            # the sieve's memory follows the span of the batch, so only its base primes bound the magnitude
+            narrow_batch = 2 * (largest_number - smallest_number + 1) < largest_number
+            if (narrow_batch and largest_number <= factorization.INT64_MAX
+                    and math.isqrt(largest_number) <= spf_table_limit):
+                backend_name = 'segmented_sieve'
+            elif largest_number <= spf_table_limit:
+                backend_name = 'spf_table'
+            elif largest_number < 2**64:
+                backend_name = 'pollard_brent'
             else:
-                data_dict['family_factors'].append(factors[:-1])
-                data_dict['identity_factor'].append(factors[-1])
-                data_dict['family_product'].append(int(np.prod(factors[:-1])))
-                data_dict['family'].append(int(np.prod(factors[:-1])))
-                self.attractors.append((int(np.prod(factors[:-1]))*len(factors)))
+                backend_name = 'big_integer'
+        if backend_name not in self.factorization_backends:
+            self.factorization_backends[backend_name] = factorization.FACTORIZATION_BACKENDS[backend_name]()
+        return self.factorization_backends[backend_name]
 
-        # prep colorization
-        if self.opt.graph_use_color_buckets:
-            self.attractors = np.array(self.attractors)
-            self.attractors = np.unique(self.attractors)
-            self.attractors = self.attractors.tolist()
+    def get_color_bucket_column(self, numbers: np.ndarray, attractors: np.ndarray) -> np.ndarray:
+        '''
+        Assign every number the color bucket of its attractor in one vectorized pass
+        Buckets take consecutive runs of the sorted unique attractors, so an attractor's rank
+        among them locates its bucket through the cumulative bucket sizes
+        '''
+        with self.timer.stage('colorization', rows=len(numbers)):
+            families = np.where(numbers > 1, attractors, 1)
+            self.attractors = np.unique(families)
             # find color base
             color_base = self.get_color_base(len(self.attractors))
             self.color_buckets = self.get_family_buckets(self.attractors, color_base)
-            for number in number_list:
-                family = 1
-                if number > 1:
-                    family = (int(np.prod(pp.factors(number)[:-1])))*len(pp.factors(number))
-                color_bucket_index = self.get_bucket_index(family)
-                data_dict['color_bucket'].append(color_bucket_index)
-
-        df = pd.DataFrame(data_dict)
-        df.reset_index()
-        self.logger.debug(f'Data collated')
-
-        return df
-
-    def get_bucket_index(self, family):
-        for index, buckets in self.color_buckets.items():
-            if family in buckets:
-                return str(index)
+            bucket_ends = self.get_bucket_ends(len(self.attractors), color_base)
+            bucket_labels = np.array([str(index) for index in self.color_buckets.keys()])
+            ranks = np.searchsorted(self.attractors, families)
+            return bucket_labels[np.searchsorted(bucket_ends, ranks, side='right')]
 
     def create_graph_title(self):
         primes_included_text = " Primes included" if self.opt.set_include_primes else " Primes excluded"
@@ -252,12 +613,105 @@ class ToolBox():
         elif self.opt.set_mode == 'range':
             title = base_text + ' :: ' + f'range {self.opt.set_range_min}..{self.opt.set_range_max}' + ' / ' + primes_included_text
 
+        elif self.opt.set_mode == 'file':
+            title = base_text + ' :: ' + f'file {os.path.basename(self.opt.set_csv_file_name)}'
+
         return title
 
 
-    def plot_data(self, dataframe):
-        data = ColumnDataSource(data=dataframe)
+    def plot_data(self, dataframe, factor_batch: FactorBatch):
+        with self.timer.stage('figure_build') as stage:
+            plot_frame = dataframe
+            plot_factors = factor_batch
+            if self.opt.graph_decimation:
+                y_value = labels.y_axis_values[self.opt.graph_mode]
+                rows = rendering.decimate(dataframe['number'], dataframe[y_value],
+                                          self.opt.graph_width, self.opt.graph_height)
+                self.logger.debug(f'Decimated {len(dataframe)} points to {len(rows)}')
+                plot_frame = dataframe.iloc[rows]
+                plot_factors = factor_batch.take(rows)
+            stage.rows = len(plot_frame)
+            on_demand_hover = self.opt.graph_hover == 'on_demand'
+            if on_demand_hover:
+                data = ColumnDataSource(data=self.get_plot_columns(plot_frame))
+            else:
+                data = ColumnDataSource(data=storage.with_factor_text(plot_frame, plot_factors))
+
+            graph = self.build_graph(data, tooltips=not on_demand_hover)
+            if on_demand_hover:
+                graph = column(graph, self.add_hover_details(graph, data, plot_factors))
+
+        output_folder, hard_copy_filename = self.save_hard_copy(dataframe, factor_batch)
+
+        self.logger.info('Graph generated')
+        with self.timer.stage('html_write', rows=len(plot_frame)):
+            if self.opt.graph_headless:
+                self.save_graph_html(graph, output_folder, hard_copy_filename)
+                return
 
+            # [x] show
+            show(graph)
+
+            self.stash_graph_html(output_folder, hard_copy_filename)
+
+    def save_graph_html(self, graph, output_folder: str, graph_filename: str) -> str:
+        '''
+        Write the graph html once, straight to the output folder, without opening a browser
+        '''
+        self.prep_folder(output_folder, False)
+        file_name = os.path.join(output_folder, graph_filename + '.html')
+        resources = INLINE if self.opt.graph_resources == 'inline' else CDN
+        save(graph, filename=file_name, resources=resources, title=self.create_graph_title())
+        self.logger.info(f'Graph saved as {file_name}')
+        return file_name
+
+    def save_hard_copy(self, dataframe, factor_batch: FactorBatch):
+        '''
+        Save the data in the output folder if configured; returns the folder and the base file name
+        In file mode the data is already on disk and only the graph html is written
+        '''
+        # [x] 'hard copy'
+        hard_copy_filename = self.create_hard_copy_filename()
+        output_folder = 'output'
+        if self.opt.set_mode == 'file':
+            # never reset here: the input file may be in the output folder
+            self.prep_folder(output_folder, False)
+        elif self.opt.run_create_csv:
+            self.prep_folder(output_folder, self.opt.run_reset_output_data)
+            self.write_data(dataframe, output_folder, hard_copy_filename, factor_batch)
+        return output_folder, hard_copy_filename
+
+    def get_plot_columns(self, dataframe) -> Dict:
+        '''
+        Return only the columns drawn by the scatter plot: x, y and color
+        y is only used for positioning and is sent in single precision
+        '''
+        y_value = labels.y_axis_values[self.opt.graph_mode]
+        plot_columns = {'number': rendering.compact_array(dataframe['number'].to_numpy()),
+                        y_value: dataframe[y_value].to_numpy(dtype=np.float32)}
+        if self.opt.graph_use_color_buckets:
+            plot_columns['color_bucket'] = dataframe['color_bucket'].to_numpy()
+        return plot_columns
+
+    def add_hover_details(self, graph: figure, data: ColumnDataSource, factor_batch: FactorBatch) -> Div:
+        '''
+        Add a hover tool that shows the details of the hovered number in a Div below the graph
+        The details are computed in the browser from a compact sidecar of the flat prime factors and their offsets
+        '''
+        details = Div(width=self.opt.graph_width)
+        factor_source = ColumnDataSource(data={'values': rendering.compact_array(factor_batch.values)})
+        offset_source = ColumnDataSource(data={'offsets': rendering.compact_array(factor_batch.offsets)})
+        callback = CustomJS(args={'data': data, 'factor_source': factor_source, 'offset_source': offset_source,
+                                  'details': details, 'include_primes': bool(self.opt.set_include_primes)},
+                            code=rendering.HOVER_DETAILS_CODE)
+        graph.add_tools(models.HoverTool(tooltips=None, callback=callback, renderers=graph.renderers))
+        return details
+
+    def build_graph(self, data: ColumnDataSource, x_range=None, tooltips: bool = True) -> figure:
+        '''
+        Build the figure with its hover tool and scatter plot over the given data source
+        Without tooltips the hover tool is left to the caller
+        '''
         # [x] create plot
         plot_width = self.opt.graph_width
         plot_height = self.opt.graph_height
@@ -267,26 +721,27 @@ class ToolBox():
         graph_params['y_axis_label'] = labels.y_axis_label[self.opt.graph_mode]
         graph_params['width'] = plot_width
         graph_params['height'] = plot_height
+        graph_params['output_backend'] = self.opt.graph_output_backend or 'canvas'
+        graph_params['x_range'] = x_range
 
         graph = self.get_figure(graph_params)
 
         # [x] add hover tool
-        tooltips = [('number', '@number')]
-        if self.opt.set_include_primes:
-            tooltips.append(('prime', '@is_prime'))
-        tooltips.extend([('factors', '@prime_factors'),
-                        ('ideal factor value', '@ideal'),
-                        ('mean factor deviation', '@deviation'),
-                        ('anti-slope', '@anti_slope'),
-                        ('attractor', '@attractor'),
-                        ('family factors', '@family_factors'),
-                        ('identity factor', '@identity_factor'),
-                        ('family product', '@family_product'),
-                        ('family', '@family'),
-                         ])
-
-        hover = models.HoverTool(tooltips=tooltips)
-        graph.add_tools(hover)
+        if tooltips:
+            tooltips = [('number', '@number')]
+            if self.opt.set_include_primes:
+                tooltips.append(('prime', '@is_prime'))
+            tooltips.extend([('factors', '@prime_factors'),
+                            ('ideal factor value', '@ideal'),
+                            ('mean factor deviation', '@deviation'),
+                            ('anti-slope', '@anti_slope'),
+                            ('attractor', '@attractor'),
+                            ('family factors', '@family_factors'),
+                            ('identity factor', '@identity_factor'),
+                            ('family product', '@family_product'),
+                            ('family', '@family'),
+                             ])
+            graph.add_tools(models.HoverTool(tooltips=tooltips))
 
         # [x] add graph
         graph_point_size = int(self.opt.graph_point_size)
@@ -294,24 +749,21 @@ class ToolBox():
         graph_params['y_value'] = labels.y_axis_values[self.opt.graph_mode]
         graph_params['graph_point_size'] = graph_point_size
 
-        graph = self.create_graph(graph, data, graph_params)
-
-        # [x] 'hard copy'
-        # hard_copy_filename = 'PLACEHOLDER_NAME'
-        hard_copy_filename = self.create_hard_copy_filename()
-        output_folder = 'output'
-        if self.opt.run_create_csv:
-            full_hard_copy_filename = hard_copy_filename + '.csv'
-            path = output_folder + '\\'
-            self.prep_folder(output_folder, self.opt.run_reset_output_data)
-            dataframe.to_csv(path + full_hard_copy_filename)
-            self.logger.info(f'Data saved as output\{full_hard_copy_filename}')
+        return self.create_graph(graph, data, graph_params)
 
-        # [x] show
-        self.logger.info('Graph generated')
-        show(graph)
+    def get_output_format(self) -> str:
+        return self.opt.run_output_format or 'csv'
 
-        self.stash_graph_html(output_folder, hard_copy_filename)
+    def write_data(self, dataframe, output_folder: str, hard_copy_filename: str, factor_batch: FactorBatch) -> str:
+        '''
+        Save the data and the factor batch of its rows in the configured output format
+        '''
+        output_format = self.get_output_format()
+        file_name = os.path.join(output_folder, hard_copy_filename + storage.OUTPUT_EXTENSIONS[output_format])
+        with self.timer.stage(f'{output_format}_write', rows=len(dataframe)):
+            storage.write_dataframe(dataframe, file_name, output_format, factor_batch)
+        self.logger.info(f'Data saved as {file_name}')
+        return file_name
 
     def create_hard_copy_filename(self):
         graph_mode_chunk = labels.graph_mode_filename_chunk[self.opt.graph_mode]
@@ -334,6 +786,8 @@ class ToolBox():
                 mode_text = f'F{len(self.opt.set_families)}_' + families_range
         elif self.opt.set_mode == 'range':
             mode_text = f'R_{self.opt.set_range_min}_{self.opt.set_range_min}_' + primes_included
+        elif self.opt.set_mode == 'file':
+            mode_text = 'File_' + os.path.splitext(os.path.basename(self.opt.set_csv_file_name))[0]
         
         hard_copy_filename = mode_text + '_' + graph_mode_chunk + '_' + timestamp
 
@@ -387,20 +841,6 @@ class ToolBox():
             primes.append(next(prime_generator))
         return primes
 
-    def int_list_to_str(self, number_list: List[int], separator=', ', use_bookends=True, bookends=['[ ', ' ]']):
-        '''
-        Generate a string from a list of integers
-        '''
-
-        stringified_list = []
-        for number in number_list:
-            stringified_list.append(str(number))
-        list_string = separator.join(stringified_list)
-        if use_bookends:
-            return bookends[0] + list_string + bookends[1]
-        else:
-            return list_string
-
     def get_figure(self, params: Dict) -> figure:
         '''
         Returns a figure with the provided parameters
@@ -409,8 +849,28 @@ class ToolBox():
         y_axis_label = params['y_axis_label']
         width = params['width']
         height = params['height']
+        output_backend = params['output_backend']
+        figure_params = {}
+        if params.get('x_range') is not None:
+            figure_params['x_range'] = params['x_range']
+
+        return figure(title=title, x_axis_label='number', y_axis_label=y_axis_label, width=width, height=height,
+                      output_backend=output_backend, **figure_params)
+
+
+# worker process state for parallel chunk computation
+worker_toolbox = None
+
+
+def init_worker(options):
+    global worker_toolbox
+    worker_toolbox = ToolBox(options)
+    worker_toolbox.set_logger(logging.getLogger(__name__))
+
 
-        return figure(title=title, x_axis_label='number', y_axis_label=y_axis_label, width=width, height=height)
+def compute_worker_chunk(chunk):
+    worker_toolbox.timer = run_report.StageTimer()
+    return worker_toolbox.compute_chunk_columns(chunk), worker_toolbox.timer.stages
 
 
 class Options(object):
@@ -452,9 +912,33 @@ class SettingsParser():
         self.graph_point_size = None
         self.graph_mode = None
         self.graph_use_color_buckets = None
+        self.graph_output_backend = None
+        self.graph_decimation = None
+        self.graph_hover = None
+        self.graph_headless = None
+        self.graph_resources = None
         self.run_create_csv = None
         self.run_hard_copy_timestamp_granularity = None
         self.run_reset_output_data = None
+        self.run_sieve_segment_size = None
+        self.run_spf_table_limit = None
+        self.run_prime_table_file = None
+        self.run_factorization_backend = None
+        self.run_workers = None
+        self.run_chunk_size = None
+        self.run_pipeline = None
+        self.run_output_format = None
+        self.run_serve = None
+        self.run_server_port = None
+        self.run_result_cache = None
+        self.run_result_cache_folder = None
+        self.run_result_cache_size_mb = None
+        self.run_incremental = None
+        self.run_report = None
+        self.run_profile_memory = None
+        self.run_profile_memory_top = None
+        self.run_profile = None
+        self.run_profile_sample_interval = None
         # DBG END
         self._read_settings(self.config_file)
         if len(self.set_families) == 1: